@@ -1,23 +1,115 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import time
+_IMPORT_STARTED = time.perf_counter()  # отсчёт для --startup-timing
 import os
 import re
+import sys
+import csv
 import json
+import heapq
+import itertools
+import sqlite3
+import stat
+import mmap
+import hashlib
+import queue
 import threading
+import contextlib
+import concurrent.futures
 import mimetypes
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
 import asyncio
+import atexit
 import logging
+import logging.handlers
+from collections import deque
 from datetime import datetime
-from pyrogram import Client
-import webbrowser  # для открытия ссылок
 
 # ====== Константы ======
 CONFIG_FILE = "config.json"
 AUTH_FILE = "auth.txt"
+STATE_FILE = "state.json"
+DIALOGS_CACHE_FILE = "dialogs_cache.json"
+DIALOGS_FULL_REFRESH = 24 * 3600  # сек.; кэш старше — полный перечитанный список
 LOG_DIR = "logs"
+LOG_FILE = "app.log"
+LOG_TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+DEFAULT_LOG_MAX_MB = 10
+DEFAULT_LOG_BACKUPS = 5
+DEFAULT_LOG_SAMPLE_RATE = 5.0  # INFO-событий одного типа в секунду
+DEFAULT_DOWNLOAD_WORKERS = 4
+MAX_DOWNLOAD_WORKERS = 32
+QUEUE_PER_WORKER = 4  # глубина очереди сканер -> загрузчики на одного воркера
+DEFAULT_PARALLEL_CHATS = 4
+DEFAULT_TOTAL_DOWNLOADS = 8
+JOBS_SHOWN = 8  # строк со статистикой по чатам в панели прогресса
+SCAN_PAGE_SIZE = 100  # сообщений за один запрос истории/поиска (максимум API)
+DEFAULT_API_RATE = 10.0  # запросов в секунду до первого FloodWait
+MIN_API_RATE = 0.2
+FLOOD_MAX_RETRIES = 5
+RATE_RELAX_INTERVAL = 30.0  # сек. без FloodWait перед ускорением темпа
+ACCOUNT_HANDOFF_FLOOD = 30  # сек.; более долгий FloodWait передаёт файл другому аккаунту
+SHORT_STREAM_BACKOFF = 5.0  # сек.; пауза после оборванного потока файла, растёт с каждой попыткой
+SHORT_STREAM_HANDOFF = 2  # оборванных потоков подряд, после которых файл передаётся другому аккаунту
+DEFAULT_WATCH_GAP_FILL = 600  # сек. между доборами пропущенного в режиме наблюдения
+WATCH_RECONNECT_DELAY = 5.0  # сек. после разрыва соединения до добора
+WATCH_RETRY_DELAY = 30.0  # сек. до повтора неудачного добора
+WATCH_MARK_INTERVAL = 5.0  # сек.; не чаще этого отметка наблюдения пишется в state.json
+WATCH_HANDLER_GROUP = 1  # группа обработчиков Pyrogram для режима наблюдения
+WATCH_QUEUE_LIMIT = 2 * SCAN_PAGE_SIZE  # записей добора, ждущих загрузки; дальше проход истории ждёт
+UI_REFRESH_MS = 66  # период обновления GUI (~15 Гц)
+CHUNK_SIZE = 1024 * 1024  # размер чанка stream_media в Pyrogram
+PART_SUFFIX = ".part"
+RANGES_SUFFIX = ".ranges"  # рядом с .part многопоточной загрузки: докачанное в каждом диапазоне
+DEFAULT_MULTIRANGE_THRESHOLD_MB = 50  # файлы от этого размера качаются в несколько потоков
+DEFAULT_MULTIRANGE_STREAMS = 4
+MULTIRANGE_MIN_CHUNKS = 8  # диапазон не короче: каждый stream_media открывает новую media-сессию
+MULTIRANGE_RETRIES = 3
+RANGES_SAVE_INTERVAL = 1.0  # сек. между перезаписью .ranges; при отмене и ошибке — сразу
+MAX_TRANSMISSIONS = 64  # потолок одновременных передач файлов на один клиент Telegram
+INDEX_FILE = ".tgmdown_index.sqlite"  # в корне папки загрузки, общий для всех чатов
+SPEED_WINDOW = 5.0  # сек.; окно мгновенной скорости
+LATENCY_SAMPLES = 2000  # последних времён загрузки файла для перцентилей
+METRICS_INTERVAL = 5.0  # сек. между перезаписью metrics_file
+MANIFEST_BATCH = 200  # строк манифеста в буфере до записи на диск
+HASH_BUFFER = 8 * 1024 * 1024  # блок чтения, если файл нельзя отобразить через mmap
+HASH_COMMIT_BATCH = 100  # записей кэша хэшей на транзакцию: блокировка записи в индексе не держится всё хэширование
+MANIFEST_FLUSH_INTERVAL = 2.0  # сек.; не реже этого буфер сбрасывается при новой строке
+
+# tkinter подгружается только для GUI: пакетный режим работает на серверах без Tk
+tk = ttk = messagebox = filedialog = None
+
+def load_tkinter():
+    global tk, ttk, messagebox, filedialog
+    import tkinter as tk
+    import tkinter.font
+    from tkinter import ttk, messagebox, filedialog
+
+# pyrogram (большая часть времени импорта) подгружается при первом подключении к Telegram:
+# окно и команда dedup его не ждут. Вызывать из потока с event loop (импорт pyrogram берёт
+# текущий loop); GUI подгружает его в потоке TelegramService после первой отрисовки
+Client = enums = None
+FloodWait = Forbidden = Unauthorized = ChannelPrivate = ChannelInvalid = PeerIdInvalid = None
+UserBannedInChannel = MsgIdInvalid = None
+_pyrogram_lock = threading.Lock()
+
+def load_pyrogram():
+    global Client, enums, FloodWait, Forbidden, Unauthorized, ChannelPrivate, ChannelInvalid, PeerIdInvalid
+    global UserBannedInChannel, MsgIdInvalid, ACCESS_ERRORS
+    with _pyrogram_lock:
+        if enums is not None:
+            return
+        from pyrogram import Client
+        from pyrogram.errors import (FloodWait, Forbidden, Unauthorized, ChannelPrivate, ChannelInvalid,
+                                     PeerIdInvalid, UserBannedInChannel, MsgIdInvalid)
+        ACCESS_ERRORS = (Forbidden, Unauthorized, ChannelPrivate, ChannelInvalid, PeerIdInvalid,
+                         UserBannedInChannel, MsgIdInvalid)
+        from pyrogram import enums  # последним: по enums проверяется, что импорт завершён
+
+def open_link(url: str):
+    import webbrowser
+    webbrowser.open(url)
 
 # ====== Окно "О программе" ======
 def make_about_window(parent):
@@ -67,10 +159,10 @@ def make_about_window(parent):
         txt.tag_bind(tag, "<Enter>", lambda e: txt.config(cursor="hand2"))
         txt.tag_bind(tag, "<Leave>", lambda e: txt.config(cursor=""))
 
-    link_tag("email", lambda: webbrowser.open("mailto:ungit42@gmail.com"))
-    link_tag("telegram_handle", lambda: webbrowser.open("https://t.me/Kelhiury"))
-    link_tag("telegram_url", lambda: webbrowser.open("https://t.me/Kelhiury"))
-    link_tag("github", lambda: webbrowser.open("https://github.com/Ungit42/Telegram_music_downloader"))
+    link_tag("email", lambda: open_link("mailto:ungit42@gmail.com"))
+    link_tag("telegram_handle", lambda: open_link("https://t.me/Kelhiury"))
+    link_tag("telegram_url", lambda: open_link("https://t.me/Kelhiury"))
+    link_tag("github", lambda: open_link("https://github.com/Ungit42/Telegram_music_downloader"))
 
     # Запрет редактирования, но разрешить копирование
     txt.bind("<Key>", lambda e: "break")
@@ -92,16 +184,109 @@ def make_about_window(parent):
     parent.wait_window(win)
 
 # ====== Логирование ======
-os.makedirs(LOG_DIR, exist_ok=True)
-logfile = os.path.join(LOG_DIR, f"app_{datetime.now().strftime('%Y-%m-%d')}.log")
-logging.basicConfig(
-    filename=logfile,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    encoding="utf-8"
-)
+# Файл пишет фоновый поток (QueueListener): logger в event loop только кладёт запись в очередь,
+# трассировки форматируются уже в потоке записи. Ротация по размеру (log_max_mb, log_backups)
+# или раз в сутки (log_rotation: "daily"); log_format: "json" — строка JSON на запись.
+# События отдельных сообщений (log_event) на уровне INFO прореживаются: не больше
+# log_sample_rate в секунду на тип, число пропущенных дописывается к следующей записи.
+# Настраивается при запуске (main/cli_main), а не при импорте модуля
 logger = logging.getLogger(__name__)
-logger.info("Запуск приложения")
+_log_listener = None
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (+{suppressed} подобных пропущено)" if suppressed else text
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "event", None) or {})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class EventSampler(logging.Filter):
+    # Корзина токенов на тип события; предупреждения и ошибки проходят всегда
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.buckets = {}  # тип -> [токены, время, пропущено]
+        self.lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        event = getattr(record, "event", None)
+        if not event or self.rate <= 0 or record.levelno > logging.INFO:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            capacity = max(1.0, self.rate)
+            bucket = self.buckets.setdefault(event.get("event"), [capacity, now, 0])
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Только подстановка аргументов; exc_info остаётся для форматтера в потоке записи
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def log_event(level: int, message: str, event: str, exc_info=False, **fields):
+    # Запись о событии одного сообщения: в JSON-формате поля идут отдельными ключами
+    logger.log(level, message, exc_info=exc_info, extra={"event": dict(fields, event=event)})
+
+def setup_logging(cfg: dict = None):
+    # Повторный вызов (другой config.json в CLI) заменяет обработчик
+    global _log_listener
+    cfg = cfg or {}
+    try:
+        max_mb = float(cfg.get("log_max_mb", DEFAULT_LOG_MAX_MB))
+        sample_rate = float(cfg.get("log_sample_rate", DEFAULT_LOG_SAMPLE_RATE))
+        backups = max(0, int(cfg.get("log_backups", DEFAULT_LOG_BACKUPS)))
+    except (TypeError, ValueError):
+        max_mb, sample_rate, backups = DEFAULT_LOG_MAX_MB, DEFAULT_LOG_SAMPLE_RATE, DEFAULT_LOG_BACKUPS
+    os.makedirs(LOG_DIR, exist_ok=True)
+    path = os.path.join(LOG_DIR, LOG_FILE)
+    if cfg.get("log_rotation") == "daily":
+        handler = logging.handlers.TimedRotatingFileHandler(path, when="midnight", backupCount=backups,
+                                                            encoding="utf-8")
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=int(max(0.0, max_mb) * 1024 * 1024),
+                                                       backupCount=backups, encoding="utf-8")
+    handler.setFormatter(JsonLogFormatter() if cfg.get("log_format") == "json" else TextLogFormatter(LOG_TEXT_FORMAT))
+    stop_logging()
+    root = logging.getLogger()
+    for old in [h for h in root.handlers if isinstance(h, LogQueueHandler)]:
+        root.removeHandler(old)
+    queue_handler = LogQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(EventSampler(sample_rate))
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    _log_listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    _log_listener.start()
+
+def stop_logging():
+    # Дописывает очередь и закрывает файл
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+atexit.register(stop_logging)
 
 # ====== Утилиты ======
 def sanitize_filename(name: str) -> str:
@@ -112,20 +297,74 @@ def sanitize_filename(name: str) -> str:
         name = "file"
     return name
 
-def load_config():
-    if os.path.exists(CONFIG_FILE):
+def load_config(path=CONFIG_FILE):
+    if os.path.exists(path):
         try:
-            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception as e:
-            logger.error(f"Ошибка загрузки config.json: {e}")
+            logger.error(f"Ошибка загрузки {path}: {e}")
             return {}
     return {}
 
-def save_config(cfg: dict):
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+def default_download_folder() -> str:
+    return os.path.join(os.path.expanduser("~"), "Music", "TelegramMusic")
+
+def save_config(cfg: dict, path=CONFIG_FILE):
+    with open(path, "w", encoding="utf-8") as f:
         json.dump(cfg, f, ensure_ascii=False, indent=4)
-    logger.info("Настройки сохранены в config.json")
+    logger.info(f"Настройки сохранены в {path}")
+
+# ====== Состояние инкрементального сканирования ======
+# state.json: {chat_id: {"scan": msg_id, "download": msg_id}} — наибольший полностью обработанный msg_id;
+# при заданных фильтрах ключ отметки дополняется ключом фильтра ("download:<key>")
+_state_lock = threading.Lock()
+
+def load_state() -> dict:
+    if os.path.exists(STATE_FILE):
+        try:
+            with open(STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {STATE_FILE}: {e}")
+    return {}
+
+def get_chat_mark(chat_id, kind: str) -> int:
+    with _state_lock:
+        return int(load_state().get(str(chat_id), {}).get(kind, 0))
+
+def set_chat_mark(chat_id, kind: str, msg_id: int):
+    with _state_lock:
+        state = load_state()
+        marks = state.setdefault(str(chat_id), {})
+        if msg_id <= marks.get(kind, 0):
+            return
+        marks[kind] = msg_id
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=4)
+        os.replace(tmp, STATE_FILE)
+    logger.info(f"Отметка {kind} для чата {chat_id}: msg_id {msg_id}")
+
+def get_int_setting(cfg: dict, key: str, default: int, lo: int = 1, hi: int = MAX_DOWNLOAD_WORKERS) -> int:
+    try:
+        value = int(cfg.get(key, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Некорректное значение {key}: {cfg.get(key)!r}")
+        value = default
+    return max(lo, min(hi, value))
+
+def get_download_workers(cfg: dict) -> int:
+    # Число одновременных загрузок в одном чате ("download_workers")
+    return get_int_setting(cfg, "download_workers", DEFAULT_DOWNLOAD_WORKERS)
+
+def parse_chat_ids(text: str) -> list:
+    # "id1, id2 @name" -> ["id1", "id2", "@name"] без повторов
+    ids = []
+    for part in re.split(r"[,;\s]+", text or ""):
+        if part and part not in ids:
+            ids.append(part)
+    return ids
 
 def create_auth_template(path=AUTH_FILE):
     if not os.path.exists(path):
@@ -187,40 +426,2703 @@ def remove_session_files(session_name: str):
     except Exception:
         pass
     return removed
+
+# ====== Ограничение частоты запросов ======
+def flood_wait_seconds(e: "FloodWait") -> int:
+    return int(getattr(e, "value", None) or getattr(e, "x", 0) or 1)
+
+# Token bucket для всех запросов к API одного аккаунта. FloodWait останавливает все
+# запросы до конца паузы сервера, вдвое снижает темп и повторяет вызов; без новых
+# FloodWait темп постепенно возвращается к исходному
+class RateLimiter:
+    def __init__(self, rate: float = DEFAULT_API_RATE, max_retries: int = FLOOD_MAX_RETRIES):
+        self.max_rate = max(MIN_API_RATE, rate)
+        self.rate = self.max_rate
+        self.max_retries = max_retries
+        self.tokens = self.max_rate
+        self.updated = time.monotonic()
+        self.flood_until = 0.0
+        self.last_flood = 0.0
+        self.flood_wait_total = 0.0
+        self.flood_count = 0
+
+    def _refill(self, now: float):
+        if self.rate < self.max_rate and now - self.last_flood >= RATE_RELAX_INTERVAL:
+            self.rate = min(self.max_rate, self.rate * 1.5)
+            self.last_flood = now
+            logger.info(f"Темп запросов увеличен до {self.rate:.2f}/с")
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def wait_flood(self):
+        # Только пауза FloodWait, без расхода токена (загрузка файлов идёт по своим лимитам)
+        while time.monotonic() < self.flood_until:
+            await asyncio.sleep(self.flood_until - time.monotonic())
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.flood_until:
+                await asyncio.sleep(self.flood_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_flood(self, seconds: float):
+        now = time.monotonic()
+        self.flood_until = max(self.flood_until, now + seconds)
+        self.last_flood = now
+        self.rate = max(MIN_API_RATE, self.rate / 2)
+        self.tokens = 0
+        self.flood_wait_total += seconds
+        self.flood_count += 1
+        logger.warning(f"FloodWait {seconds} с, темп запросов снижен до {self.rate:.2f}/с")
+
+    async def call(self, fn, *args, **kwargs):
+        # fn вызывается заново на каждой попытке, поэтому передаётся функция, а не корутина
+        for attempt in range(self.max_retries + 1):
+            await self.acquire()
+            try:
+                return await fn(*args, **kwargs)
+            except FloodWait as e:
+                if attempt == self.max_retries:
+                    raise
+                self.on_flood(flood_wait_seconds(e))
+
+    def snapshot(self) -> dict:
+        return {"api_rate": round(self.rate, 2), "flood_waits": self.flood_count,
+                "flood_wait_seconds": round(self.flood_wait_total, 1)}
+
+def make_rate_limiter(cfg: dict) -> RateLimiter:
+    try:
+        rate = float(cfg.get("api_rate", DEFAULT_API_RATE))
+    except (TypeError, ValueError):
+        logger.warning(f"Некорректное значение api_rate: {cfg.get('api_rate')!r}")
+        rate = DEFAULT_API_RATE
+    return RateLimiter(rate)
+
+# Общий лимит скорости скачивания на все загрузки (байт/с) с расписанием по времени суток:
+# "bandwidth_schedule": [{"from": "09:00", "to": "18:00", "max_bandwidth": 1}] — МБ/с в окне,
+# вне окон действует "max_bandwidth" (0 — без ограничения). Окно может переходить через полночь
+def parse_clock(value) -> int:
+    hours, minutes = str(value).strip().split(":")
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError(value)
+    return minute
+
+class BandwidthLimiter:
+    def __init__(self, limit: float = 0.0, schedule: list = ()):
+        self.limit = limit  # байт/с
+        self.schedule = list(schedule)  # [(начало, конец в минутах суток, байт/с)]
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def current_limit(self) -> float:
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, limit in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return limit
+        return self.limit
+
+    async def consume(self, n: int):
+        # Token bucket с долгом: каждый поток ждёт, пока общий долг не погасится по текущему лимиту
+        limit = self.current_limit()
+        if not limit:
+            return
+        now = time.monotonic()
+        self.tokens = min(max(limit, CHUNK_SIZE), self.tokens + (now - self.updated) * limit) - n
+        self.updated = now
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / limit)
+
+def make_bandwidth_limiter(cfg: dict) -> BandwidthLimiter:
+    def mbps(value, key):
+        try:
+            return max(0.0, float(value or 0)) * 1024 * 1024
+        except (TypeError, ValueError):
+            logger.warning(f"Некорректное значение {key}: {value!r}")
+            return 0.0
+
+    schedule = []
+    for window in cfg.get("bandwidth_schedule") or []:
+        try:
+            schedule.append((parse_clock(window["from"]), parse_clock(window["to"]),
+                             mbps(window.get("max_bandwidth"), "bandwidth_schedule")))
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Некорректное окно bandwidth_schedule: {window!r}")
+    return BandwidthLimiter(mbps(cfg.get("max_bandwidth"), "max_bandwidth"), schedule)
+
+async def collect_async(gen) -> list:
+    return [item async for item in gen]
+
+# ====== Движок сканирования ======
+
+def is_audio_message(msg) -> bool:
+    return bool(getattr(msg, "audio", None) or getattr(msg, "voice", None))
+
+def media_of(msg):
+    return getattr(msg, "audio", None) or getattr(msg, "voice", None)
+
+def message_file_name(msg) -> str:
+    if getattr(msg, "audio", None):
+        ext = mimetypes.guess_extension(msg.audio.mime_type or "") or ".mp3"
+        return msg.audio.file_name or f"audio_{msg.id}{ext}"
+    return f"voice_{msg.id}.ogg"
+
+# Компактная запись о найденном файле: вместо полного Message (чат, автор, entities,
+# ответы) хранятся только поля, нужные отчётам и загрузчику; скачивание идёт по file_id
+class AudioRecord:
+    __slots__ = ("message_id", "kind", "file_name", "mime_type", "duration", "size",
+                 "date", "file_unique_id", "file_id", "performer", "title")
+
+    def __init__(self, message_id, kind, file_name, mime_type=None, duration=None, size=0,
+                 date=0, file_unique_id=None, file_id=None, performer=None, title=None):
+        self.message_id = message_id
+        self.kind = kind
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.duration = duration
+        self.size = size
+        self.date = date  # unix time
+        self.file_unique_id = file_unique_id
+        self.file_id = file_id
+        self.performer = performer
+        self.title = title
+
+    @classmethod
+    def from_message(cls, msg):
+        media = media_of(msg)
+        date = getattr(msg, "date", None)
+        return cls(
+            msg.id,
+            "audio" if getattr(msg, "audio", None) else "voice",
+            message_file_name(msg),
+            getattr(media, "mime_type", None),
+            getattr(media, "duration", None),
+            getattr(media, "file_size", 0) or 0,
+            int(date.timestamp()) if date else 0,
+            getattr(media, "file_unique_id", None),
+            getattr(media, "file_id", None),
+            getattr(media, "performer", None),
+            getattr(media, "title", None),
+        )
+
+    def date_str(self) -> str:
+        return datetime.fromtimestamp(self.date).strftime('%Y-%m-%d %H:%M:%S') if self.date else "N/A"
+
+async def merge_history_desc(*streams):
+    # Слияние нескольких потоков сообщений (каждый от новых к старым) в один общий поток
+    iterators = [s.__aiter__() for s in streams]
+    heads = {}
+    try:
+        for it in iterators:
+            try:
+                heads[it] = await it.__anext__()
+            except StopAsyncIteration:
+                pass
+        while heads:
+            it = max(heads, key=lambda k: heads[k].id)
+            yield heads[it]
+            try:
+                heads[it] = await it.__anext__()
+            except StopAsyncIteration:
+                del heads[it]
+    finally:
+        for it in iterators:
+            try:
+                await it.aclose()
+            except Exception:
+                pass
+
+# ====== Фильтры сканирования ======
+# Спецификация ("filters" в config.json, поля GUI, аргументы CLI) один раз компилируется
+# в предикат над AudioRecord. Тип (музыка/голосовые) сужает серверный поиск, даты
+# превращаются в смещение истории (offset_date) и раннюю остановку обхода
+FILTER_KEYS = ("date_from", "date_to", "min_size_mb", "max_size_mb", "min_duration", "max_duration",
+               "kind", "mime", "performer", "title", "file_name")
+FILTER_NUMBER_KEYS = ("min_size_mb", "max_size_mb", "min_duration", "max_duration")
+FILTER_KINDS = {"audio": "AUDIO", "voice": "VOICE_NOTE"}  # имена enums.MessagesFilter
+
+def parse_filter_date(value, end: bool = False):
+    # "YYYY-MM-DD" или "YYYY-MM-DD HH:MM" -> unix time; для конца диапазона дата без времени включает весь день
+    if not value:
+        return None
+    text = str(value).strip()
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            moment = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if end and fmt == "%Y-%m-%d":
+            return int(moment.timestamp()) + 24 * 3600 - 1
+        return int(moment.timestamp())
+    raise ValueError(f"Некорректная дата фильтра: {text!r} (ожидается ГГГГ-ММ-ДД)")
+
+def parse_filter_number(spec: dict, key: str):
+    value = spec.get(key)
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Некорректное значение фильтра {key}: {value!r}")
+
+def compile_regex(spec: dict, key: str):
+    pattern = spec.get(key)
+    if not pattern:
+        return None
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"Некорректное регулярное выражение {key}: {e}")
+
+def normalize_filter_spec(spec: dict) -> dict:
+    # От spec зависит ключ отметки, а GUI даёт строки ("10"), CLI — числа (10.0):
+    # числа приводятся к float, строки — без пробелов по краям, пустые значения убираются
+    normalized = {}
+    for key, value in (spec or {}).items():
+        if key not in FILTER_KEYS:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        if value in (None, "", "all"):
+            continue
+        normalized[key] = parse_filter_number({key: value}, key) if key in FILTER_NUMBER_KEYS else value
+    return normalized
+
+class ScanFilter:
+    def __init__(self, spec: dict = None):
+        self.spec = normalize_filter_spec(spec)
+        self.date_from = parse_filter_date(self.spec.get("date_from"))
+        self.date_to = parse_filter_date(self.spec.get("date_to"), end=True)
+        kind = self.spec.get("kind", "all")
+        if kind != "all" and kind not in FILTER_KINDS:
+            raise ValueError(f"Некорректный тип фильтра: {kind!r} (audio, voice или all)")
+        self.kinds = tuple(FILTER_KINDS) if kind == "all" else (kind,)
+        # Отдельная отметка прогона для каждого набора фильтров: смена фильтров не прячет сообщения
+        self.key = hashlib.sha1(json.dumps(self.spec, sort_keys=True).encode()).hexdigest()[:8] if self.spec else ""
+        self.match = self._compile()
+
+    def __bool__(self) -> bool:
+        return bool(self.spec)
+
+    @property
+    def search_filters(self) -> tuple:
+        return tuple(getattr(enums.MessagesFilter, FILTER_KINDS[kind]) for kind in self.kinds)
+
+    def history_offset_date(self):
+        # get_chat_history отдаёт сообщения строго старше offset_date
+        return datetime.fromtimestamp(self.date_to + 1) if self.date_to else None
+
+    def is_before_range(self, msg) -> bool:
+        # Сообщения идут от новых к старым: всё дальше тоже старше date_from
+        date = getattr(msg, "date", None)
+        return bool(self.date_from and date and date.timestamp() < self.date_from)
+
+    def _compile(self):
+        checks = []
+        spec = self.spec
+        if len(self.kinds) == 1:
+            kind = self.kinds[0]
+            checks.append(lambda rec: rec.kind == kind)
+        if self.date_from:
+            date_from = self.date_from
+            checks.append(lambda rec: rec.date >= date_from)
+        if self.date_to:
+            date_to = self.date_to
+            checks.append(lambda rec: rec.date <= date_to)
+        min_size, max_size = parse_filter_number(spec, "min_size_mb"), parse_filter_number(spec, "max_size_mb")
+        if min_size is not None:
+            min_bytes = min_size * 1024 * 1024
+            checks.append(lambda rec: rec.size >= min_bytes)
+        if max_size is not None:
+            max_bytes = max_size * 1024 * 1024
+            checks.append(lambda rec: rec.size <= max_bytes)
+        min_duration, max_duration = parse_filter_number(spec, "min_duration"), parse_filter_number(spec, "max_duration")
+        if min_duration is not None:
+            checks.append(lambda rec: (rec.duration or 0) >= min_duration)
+        if max_duration is not None:
+            checks.append(lambda rec: (rec.duration or 0) <= max_duration)
+        if spec.get("mime"):
+            # Через запятую: "audio/flac", "audio/" (префикс) или расширения ".mp3"/"mp3"
+            tokens = [t.strip().lower() for t in re.split(r"[,;\s]+", str(spec["mime"])) if t.strip()]
+            mimes = tuple(t.rstrip("*") for t in tokens if "/" in t)
+            exts = tuple(t if t.startswith(".") else "." + t for t in tokens if "/" not in t)
+            checks.append(lambda rec: bool((mimes and (rec.mime_type or "").lower().startswith(mimes)) or
+                                           (exts and rec.file_name.lower().endswith(exts))))
+        for key, attr in (("performer", "performer"), ("title", "title"), ("file_name", "file_name")):
+            regex = compile_regex(spec, key)
+            if regex is not None:
+                checks.append(lambda rec, search=regex.search, attr=attr: search(getattr(rec, attr) or "") is not None)
+        if not checks:
+            return lambda rec: True
+        if len(checks) == 1:
+            return checks[0]
+        return lambda rec: all(check(rec) for check in checks)
+
+def cli_filter_spec(args, cfg: dict) -> dict:
+    # Аргументы CLI поверх "filters" из config.json
+    spec = dict(cfg.get("filters") or {})
+    for key in FILTER_KEYS:
+        value = getattr(args, key, None)
+        if value is not None:
+            spec[key] = value
+    return spec
+
+# Поиск аудио и голосовых в чате: серверный поиск с фильтрами (количество — через
+# search_messages_count), при недоступности поиска — один проход по истории.
+# min_id > 0 — инкрементальный режим: выдаются только сообщения новее min_id,
+# обход (от новых к старым) обрывается на первом уже обработанном сообщении
+# Все запросы идут постранично через RateLimiter: после FloodWait повторяется только
+# одна страница, а не весь обход
+class AudioScanner:
+    def __init__(self, app, chat_id, min_id: int = 0, limiter: RateLimiter = None, scan_filter: ScanFilter = None):
+        self.app = app
+        self.chat_id = chat_id
+        self.min_id = min_id
+        self.limiter = limiter or RateLimiter()
+        self.filter = scan_filter or ScanFilter()
+        self.filtered = 0
+        self.total = 0
+        self.processed = 0
+        self.use_search = True
+        self.top_id = 0
+        self.last_id = 0
+
+    async def count(self) -> int:
+        try:
+            self.total = 0
+            for flt in self.filter.search_filters:
+                self.total += await self.limiter.call(self.app.search_messages_count, self.chat_id, filter=flt)
+            self.use_search = True
+        except Exception as e:
+            logger.warning(f"Поиск по фильтрам недоступен для {self.chat_id}, проход по истории: {e}")
+            self.use_search = False
+            self.total = await self.limiter.call(self.app.get_chat_history_count, self.chat_id)
+        return self.total
+
+    async def _pages(self, fetch_page):
+        # fetch_page(last_msg, fetched) -> страница сообщений; пустая страница — конец
+        last, fetched = None, 0
+        while True:
+            page = await self.limiter.call(fetch_page, last, fetched)
+            if not page:
+                return
+            for msg in page:
+                yield msg
+            last, fetched = page[-1], fetched + len(page)
+
+    def _search(self, flt):
+        return self._pages(lambda last, fetched: collect_async(
+            self.app.search_messages(self.chat_id, filter=flt, offset=fetched, limit=SCAN_PAGE_SIZE)))
+
+    def _seen(self, msg) -> bool:
+        # False — достигнута отметка предыдущего прогона, дальше только старые сообщения
+        if msg.id <= self.min_id:
+            return False
+        self.processed += 1
+        self.top_id = max(self.top_id, msg.id)
+        self.last_id = msg.id
+        return True
+
+    def _history_page(self, last, offset_id):
+        if last or offset_id or not self.filter.date_to:
+            return self.app.get_chat_history(self.chat_id, limit=SCAN_PAGE_SIZE, offset_id=last.id if last else offset_id)
+        # Первая страница сразу с конца диапазона дат: более новая история не запрашивается
+        return self.app.get_chat_history(self.chat_id, limit=SCAN_PAGE_SIZE, offset_date=self.filter.history_offset_date())
+
+    async def _history(self, offset_id=0):
+        pages = self._pages(lambda last, fetched: collect_async(self._history_page(last, offset_id)))
+        async for msg in pages:
+            if self.filter.is_before_range(msg) or not self._seen(msg):
+                return
+            if is_audio_message(msg):
+                yield msg
+
+    async def iter_messages(self):
+        if not self.use_search:
+            async for msg in self._history():
+                yield msg
+            return
+        try:
+            streams = [self._search(flt) for flt in self.filter.search_filters]
+            async for msg in merge_history_desc(*streams):
+                if self.filter.is_before_range(msg) or not self._seen(msg):
+                    return
+                if is_audio_message(msg):
+                    yield msg
+            return
+        except Exception as e:
+            logger.warning(f"Ошибка поиска в {self.chat_id} после msg_id {self.last_id or 'N/A'}, продолжение по истории: {e}")
+        # Продолжаем с места обрыва: всё новее last_id уже выдано
+        self.use_search = False
+        self.processed = 0
+        self.total = await self.limiter.call(self.app.get_chat_history_count, self.chat_id)
+        async for msg in self._history(offset_id=self.last_id):
+            yield msg
+
+    async def iter_records(self):
+        match = self.filter.match
+        async for msg in self.iter_messages():
+            rec = AudioRecord.from_message(msg)
+            if match(rec):
+                yield rec
+            else:
+                self.filtered += 1
+
+    def progress(self) -> float:
+        if self.min_id:
+            # Счётчики сервера не учитывают отметку — прогресс по диапазону msg_id
+            if not self.top_id or self.top_id <= self.min_id:
+                return 0.0
+            return min(100.0, (self.top_id - self.last_id) / (self.top_id - self.min_id) * 100)
+        if not self.total:
+            return 0.0
+        return min(100.0, self.processed / self.total * 100)
+
+# ====== Загрузка файлов ======
+class DownloadCancelled(Exception):
+    pass
+
+class ShortStream(IOError):
+    # Поток файла несколько раз подряд закончился раньше времени. Pyrogram (get_file) не пробрасывает
+    # FloodWait дольше 30 с и сетевые ошибки, а пишет их в лог и завершает stream_media
+    pass
+
+def is_complete_file(path: str, expected_size: int) -> bool:
+    if not os.path.exists(path):
+        return False
+    size = os.path.getsize(path)
+    return size == expected_size if expected_size else size > 0
+
+# Индекс скачанных файлов: file_unique_id -> путь и размер. Ключи загружаются в память
+# один раз за прогон, поэтому проверка "уже скачано" не трогает ни диск, ни сеть
+class MediaIndex:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.conn = sqlite3.connect(os.path.join(folder, INDEX_FILE))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            "file_unique_id TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, "
+            "chat_id TEXT, message_id INTEGER, added_at TEXT)"
+        )
+        self.conn.commit()
+        self.known = {row[0] for row in self.conn.execute("SELECT file_unique_id FROM media")}
+        self.pending = set()  # скачиваются сейчас (во всех чатах прогона)
+
+    def __contains__(self, file_unique_id) -> bool:
+        return file_unique_id in self.known
+
+    def claim(self, file_unique_id) -> bool:
+        # False — файл уже есть или его качает другой воркер
+        if not file_unique_id:
+            return True
+        if file_unique_id in self.known or file_unique_id in self.pending:
+            return False
+        self.pending.add(file_unique_id)
+        return True
+
+    def release(self, file_unique_id):
+        self.pending.discard(file_unique_id)
+
+    def __len__(self) -> int:
+        return len(self.known)
+
+    def add(self, file_unique_id, path: str, size: int, chat_id, message_id: int):
+        if not file_unique_id:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?)",
+            (file_unique_id, os.path.relpath(path, self.folder), size, str(chat_id), message_id,
+             datetime.now().isoformat(timespec="seconds"))
+        )
+        self.conn.commit()
+        self.known.add(file_unique_id)
+        self.pending.discard(file_unique_id)
+
+    def close(self):
+        self.conn.close()
+
+# Порядок загрузки внутри чата ("download_order"): newest — порядок истории (по умолчанию),
+# oldest — от старых к новым, smallest — по размеру, sjf — по числу запросов чанков (короткие
+# задачи вперёд, при равенстве — новые). Кроме newest, очередь приоритетная и без ограничения
+# длины: сканер не ждёт воркеров, и порядок действует на всё, что уже найдено
+DOWNLOAD_ORDERS = {
+    "newest": None,
+    "oldest": lambda rec: rec.message_id,
+    "smallest": lambda rec: rec.size,
+    "sjf": lambda rec: (-(-rec.size // CHUNK_SIZE), -rec.message_id),
+}
+
+def get_download_order(cfg: dict) -> str:
+    order = str(cfg.get("download_order", "newest")).lower()
+    if order not in DOWNLOAD_ORDERS:
+        logger.warning(f"Некорректное значение download_order: {order!r}")
+        return "newest"
+    return order
+
+class OrderedQueue(asyncio.PriorityQueue):
+    # Интерфейс обычной очереди (put(rec)/get()), записи выдаются по ключу; None — после всех записей
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+        self.seq = itertools.count()
+
+    def _put(self, item):
+        entry = (1, (), next(self.seq), None) if item is None else (0, self.key(item), next(self.seq), item)
+        heapq.heappush(self._queue, entry)
+
+    def _get(self):
+        return heapq.heappop(self._queue)[-1]
+
+def numbered_path(path: str, msg_id: int) -> str:
+    # Другой трек с тем же именем файла: "name (msg_id).ext"
+    base, ext = os.path.splitext(path)
+    return f"{base} ({msg_id}){ext}"
+
+def _resume_chunks(part_path: str) -> int:
+    # Число полных чанков в .part; неполный хвост отбрасывается
+    if not os.path.exists(part_path):
+        return 0
+    done_chunks = os.path.getsize(part_path) // CHUNK_SIZE
+    with open(part_path, "r+b") as f:
+        f.truncate(done_chunks * CHUNK_SIZE)
+    return done_chunks
+
+def get_multirange_settings(cfg: dict):
+    # (порог в байтах, число потоков); порог 0 — многопоточная загрузка выключена
+    try:
+        threshold = float(cfg.get("multirange_threshold_mb", DEFAULT_MULTIRANGE_THRESHOLD_MB))
+    except (TypeError, ValueError):
+        logger.warning(f"Некорректное значение multirange_threshold_mb: {cfg.get('multirange_threshold_mb')!r}")
+        threshold = DEFAULT_MULTIRANGE_THRESHOLD_MB
+    streams = get_int_setting(cfg, "multirange_streams", DEFAULT_MULTIRANGE_STREAMS, hi=16)
+    return int(max(0.0, threshold) * 1024 * 1024), streams
+
+def get_transmissions(cfg: dict) -> int:
+    # max_concurrent_transmissions для Client. Pyrogram по умолчанию пропускает одну передачу:
+    # get_file держит семафор весь stream_media, и пул загрузок качал бы по одному файлу.
+    # Каждая загрузка может занять до multirange_streams передач; потолок — MAX_TRANSMISSIONS
+    downloads = max(get_download_workers(cfg), get_int_setting(cfg, "max_total_downloads", DEFAULT_TOTAL_DOWNLOADS,
+                                                               hi=MAX_DOWNLOAD_WORKERS * 4))
+    threshold, streams = get_multirange_settings(cfg)
+    return min(MAX_TRANSMISSIONS, downloads * (streams if threshold else 1))
+
+def _split_ranges(first: int, total: int, streams: int) -> list:
+    # Чанки [first, total) -> до streams непрерывных диапазонов [start, end, готово чанков]
+    if first >= total:
+        return []
+    count = max(1, min(streams, (total - first) // MULTIRANGE_MIN_CHUNKS))
+    step = -(-(total - first) // count)
+    return [[start, min(start + step, total), 0] for start in range(first, total, step)]
+
+def _load_ranges(ranges_path: str, expected_size: int):
+    # Список [start, end, готово чанков] или None, если файл не подходит
+    try:
+        with open(ranges_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("size") == expected_size and data.get("ranges"):
+            return [[int(start), int(end), int(done)] for start, end, done in data["ranges"]]
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать {ranges_path}: {e}")
+    logger.warning(f"{ranges_path} не подходит, файл будет скачан заново")
+    return None
+
+def _save_ranges(ranges_path: str, expected_size: int, ranges: list):
+    tmp = ranges_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"size": expected_size, "ranges": ranges}, f)
+    os.replace(tmp, ranges_path)
+
+async def download_ranges(app, media, part_path: str, expected_size: int, streams: int, should_stop=None,
+                          limiter: RateLimiter = None, on_bytes=None, bandwidth: BandwidthLimiter = None,
+                          handoff_flood: int = None):
+    # Большой файл: .part размечается на полный размер и делится на streams непрерывных диапазонов.
+    # Каждый диапазон качается одним долгим stream_media (одна media-сессия) и пишется по своему
+    # смещению; число готовых чанков диапазонов сохраняется в .ranges не реже RANGES_SAVE_INTERVAL
+    # и при отмене или ошибке, так что обрыв или перезапуск продолжают диапазон с сохранённого чанка
+    limiter = limiter or RateLimiter()
+    ranges_path = part_path + RANGES_SUFFIX
+    total = -(-expected_size // CHUNK_SIZE)
+    tail = expected_size - (total - 1) * CHUNK_SIZE  # размер последнего чанка файла
+
+    def done_bytes(rng):
+        return min((rng[0] + rng[2]) * CHUNK_SIZE, expected_size) - rng[0] * CHUNK_SIZE
+
+    ranges = None
+    if os.path.exists(ranges_path):
+        have = 0
+        if os.path.exists(part_path):
+            ranges = _load_ranges(ranges_path, expected_size)
+    else:
+        # .part последовательной загрузки: его полные чанки — готовый первый диапазон
+        have = min(_resume_chunks(part_path), total)
+    if ranges is None:
+        ranges = ([[0, have, have]] if have else []) + _split_ranges(have, total, streams)
+    with open(part_path, "ab"):
+        pass
+    with open(part_path, "r+b") as f:
+        f.truncate(expected_size)
+    _save_ranges(ranges_path, expected_size, ranges)
+    saved_at = time.monotonic()
+    resumed = sum(done_bytes(rng) for rng in ranges)
+    if resumed:
+        log_event(logging.INFO, f"Докачка {part_path} с {resumed} байт в {len(ranges)} диапазонах", "resumed",
+                  path=part_path, bytes=resumed, ranges=len(ranges))
+        if on_bytes:
+            on_bytes(resumed, True)
+
+    async def fetch(rng):
+        # Обрыв: повтор с последнего полного чанка; MULTIRANGE_RETRIES — попыток подряд без прогресса
+        nonlocal saved_at
+        start, end = rng[0], rng[1]
+        floods = 0
+        attempt = 0
+        while rng[2] < end - start:
+            await limiter.wait_flood()
+            before = rng[2]
+            offset = start + rng[2]
+            try:
+                with open(part_path, "r+b") as f:
+                    f.seek(offset * CHUNK_SIZE)
+                    async for chunk in app.stream_media(media, offset=offset, limit=end - offset):
+                        f.write(chunk)
+                        expected = tail if start + rng[2] == total - 1 else CHUNK_SIZE
+                        if len(chunk) != expected:
+                            raise IOError(f"Чанк {start + rng[2]} {part_path}: {len(chunk)} байт, ожидалось {expected}")
+                        if on_bytes:
+                            on_bytes(len(chunk), False)
+                        rng[2] += 1
+                        f.flush()
+                        if time.monotonic() - saved_at >= RANGES_SAVE_INTERVAL:
+                            _save_ranges(ranges_path, expected_size, ranges)
+                            saved_at = time.monotonic()
+                        if bandwidth:
+                            await bandwidth.consume(len(chunk))
+                        if should_stop and should_stop():
+                            raise DownloadCancelled(part_path)
+                        if rng[2] == end - start:
+                            break
+                if rng[2] == end - start:
+                    return
+                error = ShortStream(f"Диапазон {start}-{end} {part_path}: готово чанков {rng[2]}, ожидалось {end - start}")
+            except FloodWait as e:
+                seconds = flood_wait_seconds(e)
+                limiter.on_flood(seconds)
+                floods += 1
+                if floods > limiter.max_retries or (handoff_flood is not None and seconds > handoff_flood):
+                    raise
+                continue
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                error = e
+            attempt = 1 if rng[2] > before else attempt + 1
+            retries = SHORT_STREAM_HANDOFF if handoff_flood is not None else MULTIRANGE_RETRIES
+            if attempt > retries:
+                raise error
+            logger.warning(f"Повтор диапазона {start}-{end} с чанка {start + rng[2]} "
+                           f"({attempt}/{retries}): {error}")
+
+    tasks = [asyncio.create_task(fetch(rng)) for rng in ranges if rng[2] < rng[1] - rng[0]]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _save_ranges(ranges_path, expected_size, ranges)
+        raise
+    os.remove(ranges_path)
+
+async def download_resumable(app, media, out_path: str, expected_size: int = 0, should_stop=None,
+                             part_key: str = None, limiter: RateLimiter = None, on_bytes=None,
+                             bandwidth: BandwidthLimiter = None, handoff_flood: int = None, streams: int = 1) -> str:
+    # Данные пишутся в <out_path>[.<part_key>].part по чанкам; при повторном запуске докачка идёт
+    # с последнего полного чанка, готовый файл атомарно переименовывается в out_path.
+    # part_key (file_unique_id) не даёт докачать в .part другого трека с тем же именем.
+    # FloodWait посреди файла: пауза в limiter и докачка с последнего чанка. Так же обрабатывается
+    # поток, кончившийся раньше файла (так Pyrogram завершает его при долгом FloodWait или обрыве сети);
+    # после limiter.max_retries таких обрывов подряд без прогресса — ShortStream (если файл может взять
+    # другой аккаунт, т.е. задан handoff_flood, — уже после SHORT_STREAM_HANDOFF).
+    # on_bytes(n, resumed) — счётчик байт: докачанное из .part передаётся с resumed=True;
+    # bandwidth — общий лимит скорости: следующий чанк запрашивается после паузы;
+    # FloodWait дольше handoff_flood не пережидается, а пробрасывается (файл возьмёт другой аккаунт);
+    # streams > 1 (или начатая многопоточная загрузка) — download_ranges
+    part_path = f"{out_path}.{part_key}{PART_SUFFIX}" if part_key else out_path + PART_SUFFIX
+    limiter = limiter or RateLimiter()
+    ranged = expected_size and (streams > 1 or os.path.exists(part_path + RANGES_SUFFIX))
+    if ranged:
+        await download_ranges(app, media, part_path, expected_size, max(2, streams), should_stop, limiter,
+                              on_bytes, bandwidth, handoff_flood)
+    floods = 0
+    stalls = 0  # оборванных потоков подряд без прогресса
+    max_stalls = SHORT_STREAM_HANDOFF if handoff_flood is not None else limiter.max_retries
+    first = True
+    while not ranged:
+        done_chunks = _resume_chunks(part_path)
+        if first and done_chunks:
+            # Повторы после обрыва потока логирует предупреждение ниже, здесь — только начало докачки
+            log_event(logging.INFO, f"Докачка {out_path} с {done_chunks * CHUNK_SIZE} байт", "resumed",
+                      path=out_path, bytes=done_chunks * CHUNK_SIZE)
+            if on_bytes:
+                on_bytes(done_chunks * CHUNK_SIZE, True)
+        first = False
+        await limiter.wait_flood()
+        try:
+            with open(part_path, "ab") as f:
+                async for chunk in app.stream_media(media, offset=done_chunks):
+                    f.write(chunk)
+                    if on_bytes:
+                        on_bytes(len(chunk), False)
+                    if bandwidth:
+                        await bandwidth.consume(len(chunk))
+                    if should_stop and should_stop():
+                        raise DownloadCancelled(part_path)
+        except FloodWait as e:
+            seconds = flood_wait_seconds(e)
+            floods += 1
+            limiter.on_flood(seconds)
+            if floods > limiter.max_retries or (handoff_flood is not None and seconds > handoff_flood):
+                raise
+            continue
+        size = os.path.getsize(part_path)
+        if not expected_size or size >= expected_size:
+            break
+        # Поток кончился раньше файла: пауза в limiter и докачка из .part
+        stalls = 1 if size // CHUNK_SIZE > done_chunks else stalls + 1
+        if stalls > max_stalls:
+            raise ShortStream(f"Поток {part_path} оборвался {stalls} раз подряд: {size} байт из {expected_size}")
+        delay = SHORT_STREAM_BACKOFF * stalls
+        logger.warning(f"Поток {out_path} оборвался на {size} байт из {expected_size}, "
+                       f"докачка через {delay:.0f} с ({stalls}/{max_stalls})")
+        limiter.on_flood(delay)
+    size = os.path.getsize(part_path)
+    if expected_size and size != expected_size:
+        raise IOError(f"Размер {part_path}: {size} байт, ожидалось {expected_size}")
+    os.replace(part_path, out_path)
+    return out_path
+
+# ====== Метрики скачивания ======
+# Байтовые счётчики, скорость, время загрузки файла и ETA. Размеры файлов известны из
+# результатов сканирования, поэтому прогресс и ETA считаются по байтам, а не по числу файлов.
+# Метрики чата пишут и в общие метрики планировщика (parent)
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+class TransferMetrics:
+    def __init__(self, parent: "TransferMetrics" = None):
+        self.parent = parent
+        self.started = time.monotonic()
+        self.bytes_expected = 0  # сумма размеров найденных файлов
+        self.bytes_done = 0      # скачано в этом прогоне
+        self.bytes_resumed = 0   # взято из .part прошлых прогонов
+        self.bytes_skipped = 0   # повторы и ошибки: в прогрессе считаются завершёнными
+        self.files_done = 0
+        self.file_seconds = 0.0  # суммарное время загрузки файлов
+        self.first_byte_at = None  # время первого полученного байта
+        self.window = deque()    # (время, байт) за последние SPEED_WINDOW сек.
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def add_expected(self, size: int):
+        self.bytes_expected += size
+        if self.parent:
+            self.parent.add_expected(size)
+
+    def add_bytes(self, n: int, resumed: bool = False):
+        if resumed:
+            self.bytes_resumed += n
+        else:
+            now = time.monotonic()
+            if self.first_byte_at is None:
+                self.first_byte_at = now
+            self.bytes_done += n
+            self.window.append((now, n))
+            while self.window and now - self.window[0][0] > SPEED_WINDOW:
+                self.window.popleft()
+        if self.parent:
+            self.parent.add_bytes(n, resumed)
+
+    def add_skipped(self, n: int):
+        self.bytes_skipped += max(0, n)
+        if self.parent:
+            self.parent.add_skipped(n)
+
+    def add_file(self, seconds: float):
+        self.files_done += 1
+        self.file_seconds += seconds
+        self.latencies.append(seconds)
+        if self.parent:
+            self.parent.add_file(seconds)
+
+    @property
+    def bytes_settled(self) -> int:
+        return self.bytes_done + self.bytes_resumed + self.bytes_skipped
+
+    def speed(self) -> float:
+        # Байт/с за последние SPEED_WINDOW сек.
+        now = time.monotonic()
+        while self.window and now - self.window[0][0] > SPEED_WINDOW:
+            self.window.popleft()
+        if not self.window:
+            return 0.0
+        span = max(now - self.window[0][0], min(SPEED_WINDOW, now - self.started), 1e-3)
+        return sum(n for _, n in self.window) / span
+
+    def average_speed(self) -> float:
+        return self.bytes_done / max(time.monotonic() - self.started, 1e-3)
+
+    def eta(self, bytes_expected: int = None):
+        # Секунд до конца по текущей (или средней) скорости; None — скорость ещё неизвестна
+        expected = self.bytes_expected if bytes_expected is None else bytes_expected
+        speed = self.speed() or self.average_speed()
+        if not speed:
+            return None
+        return max(0.0, expected - self.bytes_settled) / speed
+
+    def snapshot(self, limiter: RateLimiter = None) -> dict:
+        eta = self.eta()
+        snap = {
+            "elapsed_seconds": round(time.monotonic() - self.started, 1),
+            "bytes_expected": self.bytes_expected,
+            "bytes_downloaded": self.bytes_done,
+            "bytes_resumed": self.bytes_resumed,
+            "bytes_skipped": self.bytes_skipped,
+            "files_downloaded": self.files_done,
+            "speed_bytes_per_second": round(self.speed()),
+            "avg_speed_bytes_per_second": round(self.average_speed()),
+            "eta_seconds": None if eta is None else round(eta),
+            "ttfb_seconds": None if self.first_byte_at is None else round(self.first_byte_at - self.started, 3),
+            "file_seconds_p50": round(percentile(self.latencies, 0.5), 3),
+            "file_seconds_p90": round(percentile(self.latencies, 0.9), 3),
+            "file_seconds_p99": round(percentile(self.latencies, 0.99), 3),
+            "file_seconds_sum": round(self.file_seconds, 3),
+        }
+        if limiter is not None:
+            snap.update(limiter.snapshot())
+        return snap
+
+def format_bytes(n: float) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if abs(n) < 1024 or unit == "ГБ":
+            return f"{n:.0f} {unit}" if unit == "Б" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60:02d}:{rest % 60:02d}"
+
+def format_metrics(snap: dict) -> str:
+    # Строка для панели прогресса GUI
+    text = (f"{format_bytes(snap['bytes_downloaded'] + snap['bytes_resumed'])} из {format_bytes(snap['bytes_expected'])} | "
+            f"{format_bytes(snap['speed_bytes_per_second'])}/с (ср. {format_bytes(snap['avg_speed_bytes_per_second'])}/с) | "
+            f"ETA {format_duration(snap['eta_seconds'])}")
+    if snap["files_downloaded"]:
+        text += f" | файл p50 {snap['file_seconds_p50']:.1f} с, p90 {snap['file_seconds_p90']:.1f} с"
+    if snap.get("flood_waits"):
+        text += f" | FloodWait: {snap['flood_waits']} ({snap['flood_wait_seconds']:.0f} с)"
+    return text
+
+def prometheus_metrics(snap: dict, jobs: list = ()) -> str:
+    # Текстовый формат Prometheus (node_exporter textfile collector)
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP tgmdown_{name} {help_text}")
+        lines.append(f"# TYPE tgmdown_{name} {kind}")
+        for labels, value in samples:
+            # labels — метки в фигурных скобках или суффикс сэмпла (_sum, _count у summary)
+            lines.append(f"tgmdown_{name}{labels} {value}")
+    metric("bytes_expected", "gauge", "Total size of found files", [("", snap["bytes_expected"])])
+    metric("bytes_downloaded_total", "counter", "Bytes downloaded in this run", [("", snap["bytes_downloaded"])])
+    metric("bytes_resumed_total", "counter", "Bytes reused from .part files", [("", snap["bytes_resumed"])])
+    metric("files_downloaded_total", "counter", "Files downloaded in this run", [("", snap["files_downloaded"])])
+    metric("speed_bytes_per_second", "gauge", "Download speed",
+           [('{window="instant"}', snap["speed_bytes_per_second"]), ('{window="average"}', snap["avg_speed_bytes_per_second"])])
+    if snap["eta_seconds"] is not None:
+        metric("eta_seconds", "gauge", "Estimated time to completion", [("", snap["eta_seconds"])])
+    metric("file_seconds", "summary", "Per-file download time",
+           [(f'{{quantile="{q}"}}', snap[f"file_seconds_p{int(q * 100)}"]) for q in (0.5, 0.9, 0.99)]
+           + [("_sum", snap["file_seconds_sum"]), ("_count", snap["files_downloaded"])])
+    if "flood_waits" in snap:
+        metric("flood_waits_total", "counter", "FloodWait errors", [("", snap["flood_waits"])])
+        metric("flood_wait_seconds_total", "counter", "Seconds spent in FloodWait", [("", snap["flood_wait_seconds"])])
+        metric("api_rate", "gauge", "Current API request rate", [("", snap["api_rate"])])
+    if jobs:
+        metric("chat_files", "gauge", "Per-chat file counters",
+               [(f'{{chat="{job.chat_id}",status="{key}"}}', value) for job in jobs for key, value in job.stats.items()])
+        metric("chat_progress_percent", "gauge", "Per-chat progress",
+               [(f'{{chat="{job.chat_id}"}}', round(job.percent, 1)) for job in jobs])
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path: str, snap: dict, jobs: list = ()):
+    # .prom — формат Prometheus, иначе JSON; файл перезаписывается атомарно
+    try:
+        if path.endswith(".prom"):
+            text = prometheus_metrics(snap, jobs)
+        else:
+            data = dict(snap, updated=datetime.now().isoformat(timespec="seconds"),
+                        chats=[dict(job.stats, chat_id=job.chat_id, percent=round(job.percent, 1)) for job in jobs])
+            text = json.dumps(data, ensure_ascii=False, indent=2)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except Exception:
+        logger.exception(f"Не удалось записать файл метрик {path}")
+
+# ====== Манифест ======
+# Одна строка на обработанное сообщение (JSONL или CSV), дописывается по ходу работы пачками:
+# после сбоя остаётся всё, кроме последней несброшенной пачки. Текстовые отчёты строятся из него
+MANIFEST_FIELDS = ("time", "chat_id", "message_id", "kind", "status", "file_name", "path", "size", "duration",
+                   "date", "file_unique_id", "performer", "title", "seconds", "error")
+
+def manifest_extension(cfg: dict) -> str:
+    fmt = str(cfg.get("manifest_format", "jsonl")).lower()
+    if fmt not in ("jsonl", "csv"):
+        logger.warning(f"Некорректное значение manifest_format: {fmt!r}")
+        return "jsonl"
+    return fmt
+
+class Manifest:
+    def __init__(self, path: str, chat_id):
+        self.path = path
+        self.chat_id = chat_id
+        self.csv = path.endswith(".csv")
+        self.buffer = []
+        self.rows = 0
+        self.last_flush = time.monotonic()
+        # Файл прогона создаётся заново: строки другого прогона с тем же именем в него не попадут
+        open(path, "w", encoding="utf-8").close()
+
+    def add(self, rec: AudioRecord, status: str, path: str = "", error: str = "", seconds: float = None):
+        # status: found | downloaded | duplicate | failed | cancelled
+        self.buffer.append({
+            "time": datetime.now().isoformat(timespec="seconds"), "chat_id": self.chat_id,
+            "message_id": rec.message_id, "kind": rec.kind, "status": status, "file_name": rec.file_name,
+            "path": path, "size": rec.size, "duration": rec.duration, "date": rec.date_str(),
+            "file_unique_id": rec.file_unique_id, "performer": rec.performer, "title": rec.title,
+            "seconds": seconds, "error": error,
+        })
+        if len(self.buffer) >= MANIFEST_BATCH or time.monotonic() - self.last_flush >= MANIFEST_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        try:
+            header = self.csv and not self.rows
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                if self.csv:
+                    writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+                    if header:
+                        writer.writeheader()
+                    writer.writerows(self.buffer)
+                else:
+                    f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in self.buffer)
+            self.rows += len(self.buffer)
+        except Exception:
+            logger.exception(f"Не удалось дописать манифест {self.path}")
+        self.buffer.clear()
+
+    close = flush
+
+def read_manifest(path: str):
+    # Строки манифеста как словари; оборванная при сбое последняя строка JSONL пропускается
+    if not path or not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Повреждённая строка манифеста {path}: {line[:80]}")
+
+# ====== Дедупликация по содержимому ======
+# Одинаковые файлы в папках разных чатов заменяются жёсткими ссылками на один экземпляр.
+# Хэшируются только файлы с совпадающим размером; хэши кэшируются в индексе папки загрузки
+# по (путь, размер, mtime), поэтому повторный проход считает только новые файлы
+SERVICE_SUFFIXES = (PART_SUFFIX, RANGES_SUFFIX, ".tmp", ".txt", ".jsonl", ".csv", ".json", ".prom", ".sqlite",
+                    ".sqlite-journal", ".log")
+
+def hash_file(path: str):
+    # Выполняется в процессе пула: (path, sha256) или (path, None) при ошибке чтения
+    try:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    digest.update(mm)
+            except (ValueError, OSError):
+                for block in iter(lambda: f.read(HASH_BUFFER), b""):
+                    digest.update(block)
+        return path, digest.hexdigest()
+    except OSError:
+        return path, None
+
+class HashCache:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.conn = sqlite3.connect(os.path.join(folder, INDEX_FILE))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+        )
+        self.conn.commit()
+        self.entries = {row[0]: row[1:] for row in self.conn.execute("SELECT path, size, mtime_ns, sha256 FROM hashes")}
+        self.uncommitted = 0
+
+    def get(self, path: str, st):
+        entry = self.entries.get(os.path.relpath(path, self.folder))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, path: str, st, digest: str):
+        rel = os.path.relpath(path, self.folder)
+        self.entries[rel] = (st.st_size, st.st_mtime_ns, digest)
+        self.conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", (rel, st.st_size, st.st_mtime_ns, digest))
+        self.uncommitted += 1
+        if self.uncommitted >= HASH_COMMIT_BATCH:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def replace_with_link(keep: str, path: str):
+    # Атомарно: ссылка создаётся рядом и переименовывается поверх дубликата
+    tmp = f"{path}.{os.getpid()}.tmp"
+    os.link(keep, tmp)
+    os.replace(tmp, path)
+
+def library_files(folder: str):
+    # (path, stat) обычных непустых файлов библиотеки без служебных файлов программы.
+    # logs/ в корне — логи программы, если папка загрузки совпадает с рабочей (app.log.1 и т. п.)
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and not (root == folder and d == LOG_DIR)]
+        for name in files:
+            if name.startswith(".") or name.endswith(SERVICE_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                yield path, st
+
+def dedup_library(folder: str, workers: int = None, dry_run: bool = False, on_progress=None) -> dict:
+    # on_progress(done, total) — по мере хэширования
+    summary = {"files": 0, "hashed": 0, "cached": 0, "groups": 0, "linked": 0, "bytes_reclaimed": 0, "errors": 0}
+    by_size = {}
+    for path, st in library_files(folder):
+        summary["files"] += 1
+        by_size.setdefault(st.st_size, []).append((path, st))
+    candidates = [item for items in by_size.values() if len(items) > 1 for item in items]
+
+    cache = HashCache(folder)
+    try:
+        digests = {}
+        stats_by_path = dict(candidates)
+        to_hash = []
+        for path, st in candidates:
+            digest = cache.get(path, st)
+            if digest:
+                digests[path] = digest
+                summary["cached"] += 1
+            else:
+                to_hash.append(path)
+        if to_hash:
+            logger.info(f"Дедупликация: хэширование {len(to_hash)} файлов")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                for done, (path, digest) in enumerate(pool.map(hash_file, to_hash, chunksize=8), 1):
+                    if digest is None:
+                        summary["errors"] += 1
+                        logger.error(f"Дедупликация: не удалось прочитать {path}")
+                    else:
+                        digests[path] = digest
+                        cache.put(path, stats_by_path[path], digest)
+                        summary["hashed"] += 1
+                    if on_progress:
+                        on_progress(done, len(to_hash))
+
+        groups = {}
+        for path, st in candidates:
+            if path in digests:
+                groups.setdefault((st.st_size, digests[path]), []).append((path, st))
+        for (size, digest), items in groups.items():
+            inodes = {}
+            for path, st in items:
+                inodes.setdefault((st.st_dev, st.st_ino), []).append((path, st))
+            if len(inodes) < 2:
+                continue
+            summary["groups"] += 1
+            # Остаётся inode, на который уже больше всего ссылок
+            keep_key = max(inodes, key=lambda key: (len(inodes[key]), inodes[key][0][1].st_nlink))
+            keep_path = inodes[keep_key][0][0]
+            for key, paths in inodes.items():
+                if key == keep_key or key[0] != keep_key[0]:
+                    continue  # жёсткие ссылки возможны только в пределах одного диска
+                relinked = 0
+                for path, st in paths:
+                    try:
+                        current = os.stat(path, follow_symlinks=False)
+                        if (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                            continue  # файл изменился после хэширования
+                        if not dry_run:
+                            replace_with_link(keep_path, path)
+                            cache.put(path, os.stat(path), digest)
+                        relinked += 1
+                    except OSError as e:
+                        summary["errors"] += 1
+                        logger.error(f"Дедупликация: {path}: {e}")
+                summary["linked"] += relinked
+                # Место освобождается, только если заменены все ссылки на старый inode
+                if relinked and relinked == len(paths) and paths[0][1].st_nlink <= len(paths):
+                    summary["bytes_reclaimed"] += size
+    finally:
+        cache.close()
+    logger.info(f"Дедупликация {folder}{' (пробный проход)' if dry_run else ''}: {summary}")
+    return summary
+
+def format_dedup_summary(summary: dict, dry_run: bool = False) -> str:
+    verb = "Можно заменить ссылками" if dry_run else "Заменено ссылками"
+    return (f"Файлов: {summary['files']} | Захэшировано: {summary['hashed']} (из кэша: {summary['cached']})\n"
+            f"Групп одинаковых файлов: {summary['groups']} | {verb}: {summary['linked']}\n"
+            f"{'Можно освободить' if dry_run else 'Освобождено'}: {format_bytes(summary['bytes_reclaimed'])}"
+            + (f"\nОшибок: {summary['errors']}" if summary["errors"] else ""))
+
+# ====== Каталог ======
+# Аудио всех чатов, найденные сканированием и скачиванием, в таблице catalog файла INDEX_FILE:
+# upsert по (chat_id, message_id); статус скачивания (downloaded/duplicate/failed) сканирование
+# не сбрасывает. Полнотекстовый поиск по исполнителю, названию и имени файла — FTS5 с внешним
+# содержимым, синхронизируется триггерами. Запись пачками по CATALOG_BATCH строк
+CATALOG_BATCH = 500
+CATALOG_LIMIT = 200  # строк в результате поиска по умолчанию
+CATALOG_FIELDS = ("chat_id", "message_id", "chat_label", "kind", "performer", "title", "file_name",
+                  "duration", "size", "date", "file_unique_id", "status", "updated_at")
+CATALOG_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS catalog ("
+    "chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, chat_label TEXT, kind TEXT, performer TEXT, "
+    "title TEXT, file_name TEXT, duration INTEGER, size INTEGER, date INTEGER, file_unique_id TEXT, "
+    "status TEXT, updated_at TEXT, PRIMARY KEY (chat_id, message_id))",
+    "CREATE INDEX IF NOT EXISTS catalog_file ON catalog (file_unique_id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5("
+    "performer, title, file_name, content='catalog', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', "
+    "prefix='2 3')",  # индекс префиксов: поиск по началу слова без перебора словаря
+    "CREATE TRIGGER IF NOT EXISTS catalog_ai AFTER INSERT ON catalog BEGIN "
+    "INSERT INTO catalog_fts (rowid, performer, title, file_name) "
+    "VALUES (new.rowid, new.performer, new.title, new.file_name); END",
+    "CREATE TRIGGER IF NOT EXISTS catalog_ad AFTER DELETE ON catalog BEGIN "
+    "INSERT INTO catalog_fts (catalog_fts, rowid, performer, title, file_name) "
+    "VALUES ('delete', old.rowid, old.performer, old.title, old.file_name); END",
+    "CREATE TRIGGER IF NOT EXISTS catalog_au AFTER UPDATE OF performer, title, file_name ON catalog BEGIN "
+    "INSERT INTO catalog_fts (catalog_fts, rowid, performer, title, file_name) "
+    "VALUES ('delete', old.rowid, old.performer, old.title, old.file_name); "
+    "INSERT INTO catalog_fts (rowid, performer, title, file_name) "
+    "VALUES (new.rowid, new.performer, new.title, new.file_name); END",
+)
+CATALOG_UPSERT = (
+    f"INSERT INTO catalog ({', '.join(CATALOG_FIELDS)}) VALUES ({', '.join('?' * len(CATALOG_FIELDS))}) "
+    "ON CONFLICT (chat_id, message_id) DO UPDATE SET "
+    + ", ".join(f"{field} = excluded.{field}" for field in CATALOG_FIELDS[2:-2])
+    + ", status = CASE WHEN excluded.status = 'found' AND catalog.status IS NOT NULL "
+      "THEN catalog.status ELSE excluded.status END, updated_at = excluded.updated_at"
+)
+
+def open_catalog_db(folder: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(folder, INDEX_FILE))
+    conn.execute("PRAGMA journal_mode=WAL")  # поиск в GUI не ждёт записи сканирования
+    for statement in CATALOG_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+class Catalog:
+    def __init__(self, folder: str):
+        self.conn = open_catalog_db(folder)
+        self.rows = []
+
+    def add(self, chat_id, chat_label: str, rec: AudioRecord, status: str):
+        self.rows.append((str(chat_id), rec.message_id, chat_label, rec.kind, rec.performer, rec.title,
+                          rec.file_name, rec.duration, rec.size, rec.date, rec.file_unique_id, status,
+                          datetime.now().isoformat(timespec="seconds")))
+        if len(self.rows) >= CATALOG_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany(CATALOG_UPSERT, self.rows)
+        except sqlite3.Error:
+            logger.exception(f"Не удалось записать {len(self.rows)} строк в каталог")
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def catalog_fts_query(text: str) -> str:
+    # Каждое слово запроса — обязательный префикс; операторы FTS5 в запросе не нужны
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text.lower()))
+
+def search_catalog(folder: str, text: str = "", chat_ids=(), kind: str = None, limit: int = CATALOG_LIMIT) -> list:
+    # Новые записи каталога первыми (в чате — новые сообщения); с текстом — только совпавшие
+    # по FTS, в порядке его индекса, без сортировки всех совпадений
+    conn = open_catalog_db(folder)
+    conn.row_factory = sqlite3.Row
+    try:
+        query = catalog_fts_query(text)
+        if query:
+            sql = ("SELECT c.* FROM catalog_fts JOIN catalog c ON c.rowid = catalog_fts.rowid "
+                   "WHERE catalog_fts MATCH ?")
+            params = [query]
+            order = "catalog_fts.rowid DESC"
+        else:
+            sql, params = "SELECT c.* FROM catalog c WHERE 1", []
+            order = "c.message_id DESC" if chat_ids else "c.rowid DESC"
+        if chat_ids:
+            sql += f" AND c.chat_id IN ({', '.join('?' * len(chat_ids))})"
+            params += [str(chat_id) for chat_id in chat_ids]
+        if kind:
+            sql += " AND c.kind = ?"
+            params.append(kind)
+        rows = conn.execute(f"{sql} ORDER BY {order} LIMIT ?", params + [int(limit)]).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+def catalog_selection(rows: list) -> dict:
+    # {chat_id: [message_id, ...]} для постановки в очередь загрузки
+    selection = {}
+    for row in rows:
+        selection.setdefault(row["chat_id"], []).append(row["message_id"])
+    return selection
+
+class SelectedMessagesSource:
+    # Источник записей run_download для сообщений, выбранных в каталоге. Сообщения перечитываются
+    # (file_id в каталоге мог устареть); отметки download не меняются
+    def __init__(self, app, chat_id, message_ids: list, limiter: RateLimiter):
+        self.app = app
+        self.chat_id = chat_id
+        self.message_ids = sorted(set(message_ids), reverse=True)
+        self.limiter = limiter
+        self.min_id = 0
+        self.top_id = 0
+        self.total = len(self.message_ids)
+        self.filtered = 0
+
+    async def count(self) -> int:
+        return self.total
+
+    async def iter_records(self):
+        for start in range(0, len(self.message_ids), SCAN_PAGE_SIZE):
+            ids = self.message_ids[start:start + SCAN_PAGE_SIZE]
+            messages = await self.limiter.call(self.app.get_messages, self.chat_id, ids)
+            for msg_id, msg in zip(ids, messages):
+                if msg is None or getattr(msg, "empty", False) or not is_audio_message(msg):
+                    logger.warning(f"Сообщение {msg_id} в {self.chat_id} недоступно или без аудио")
+                    continue
+                yield AudioRecord.from_message(msg)
+
+    def settle(self, rec: AudioRecord, status: str):
+        pass
+
+# ====== Кэш списка чатов ======
+# dialogs_cache.json: {session_name: {"updated": unix time, "dialogs": [...]}}; каждая запись —
+# {"id", "title", "username", "top_id", "pinned"} в порядке get_dialogs (по последней активности)
+def dialog_label(entry: dict) -> str:
+    uname = entry.get("username") or ""
+    return f"{entry.get('title') or 'Чат'} ({entry['id']})" + (f" [@{uname}]" if uname else "")
+
+def load_dialog_cache(session_name: str):
+    if os.path.exists(DIALOGS_CACHE_FILE):
+        try:
+            with open(DIALOGS_CACHE_FILE, "r", encoding="utf-8") as f:
+                cached = json.load(f).get(session_name) or {}
+            return cached.get("dialogs", []), cached.get("updated", 0)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {DIALOGS_CACHE_FILE}: {e}")
+    return [], 0
+
+def save_dialog_cache(session_name: str, dialogs: list):
+    data = {}
+    if os.path.exists(DIALOGS_CACHE_FILE):
+        try:
+            with open(DIALOGS_CACHE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            data = {}
+    data[session_name] = {"updated": int(time.time()), "dialogs": dialogs}
+    tmp = DIALOGS_CACHE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, DIALOGS_CACHE_FILE)
+
+def remove_dialog_cache():
+    if os.path.exists(DIALOGS_CACHE_FILE):
+        os.remove(DIALOGS_CACHE_FILE)
+
+async def fetch_dialogs(app, cached: list, full: bool = False) -> list:
+    # get_dialogs отдаёт чаты по последней активности (закреплённые — первыми), поэтому
+    # при неполном обновлении обход останавливается на первом незакреплённом чате,
+    # у которого не изменилось последнее сообщение; остальное берётся из кэша
+    known = {entry["id"]: entry for entry in cached}
+    fresh = []
+    async for dlg in app.get_dialogs():
+        chat = dlg.chat
+        top = getattr(dlg, "top_message", None)
+        entry = {
+            "id": chat.id,
+            "title": getattr(chat, "title", None) or getattr(chat, "first_name", None) or "Чат",
+            "username": getattr(chat, "username", "") or "",
+            "top_id": getattr(top, "id", 0) or 0,
+            "pinned": bool(getattr(dlg, "is_pinned", False)),
+        }
+        old = known.get(chat.id)
+        if not full and not entry["pinned"] and old is not None and old == entry:
+            break
+        fresh.append(entry)
+    else:
+        return fresh
+    seen = {entry["id"] for entry in fresh}
+    return fresh + [entry for entry in cached if entry["id"] not in seen]
+
+# ====== Фоновый клиент Telegram ======
+# Отдельный поток с постоянным event loop и одним подключённым Client.
+# Все операции (авторизация, список чатов, сканирование, скачивание) отправляются
+# в него через submit()/call() и переиспользуют уже установленное соединение
+class TelegramService:
+    def __init__(self, transmissions: int = 1):
+        self.loop = asyncio.new_event_loop()
+        self.transmissions = transmissions  # max_concurrent_transmissions клиента (get_transmissions)
+        self.client = None
+        self._credentials = None
+        self._client_lock = None
+        self.thread = threading.Thread(target=self._run, name="telegram-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self._client_lock = asyncio.Lock()
+        self.loop.run_forever()
+
+    def submit(self, coro_fn, *args, **kwargs):
+        # Возвращает concurrent.futures.Future с результатом корутины
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args, **kwargs), self.loop)
+
+    def call(self, coro_fn, *args, timeout=None, **kwargs):
+        return self.submit(coro_fn, *args, **kwargs).result(timeout)
+
+    async def get_client(self, session_name: str, api_id: int, api_hash: str):
+        async with self._client_lock:
+            credentials = (session_name, api_id, api_hash)
+            if self.client is not None and self._credentials != credentials:
+                await self._stop_client()
+            if self.client is None:
+                load_pyrogram()
+                # Client создаётся внутри loop: Pyrogram запоминает текущий event loop
+                self.client = Client(session_name, api_id=api_id, api_hash=api_hash,
+                                     max_concurrent_transmissions=self.transmissions)
+                self._credentials = credentials
+            if not self.client.is_connected:
+                logger.info(f"Подключение клиента Telegram (сессия {session_name})")
+                await self.client.start()
+            return self.client
+
+    @contextlib.asynccontextmanager
+    async def session(self, session_name: str, api_id: int, api_hash: str):
+        # Замена "async with Client(...)": соединение после выхода не закрывается
+        yield await self.get_client(session_name, api_id, api_hash)
+
+    async def run(self, session_name: str, api_id: int, api_hash: str, op):
+        # Короткие операции: при обрыве соединения клиент переподключается и операция повторяется
+        client = await self.get_client(session_name, api_id, api_hash)
+        try:
+            return await op(client)
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"Соединение потеряно ({e}), переподключение")
+            await self.reconnect()
+            client = await self.get_client(session_name, api_id, api_hash)
+            return await op(client)
+
+    async def reconnect(self):
+        async with self._client_lock:
+            if self.client is not None and self.client.is_connected:
+                try:
+                    await self.client.stop()
+                except Exception:
+                    logger.exception("Ошибка остановки клиента при переподключении")
+
+    async def _stop_client(self):
+        client, self.client, self._credentials = self.client, None, None
+        if client is not None and client.is_connected:
+            try:
+                await client.stop()
+            except Exception:
+                logger.exception("Ошибка остановки клиента Telegram")
+
+    async def stop_client(self):
+        async with self._client_lock:
+            await self._stop_client()
+
+    def shutdown(self, timeout=5):
+        try:
+            self.call(self.stop_client, timeout=timeout)
+        except Exception:
+            logger.exception("Клиент Telegram не остановлен при выходе")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# ====== Несколько аккаунтов ======
+# Дополнительные сессии ("accounts" в config.json) делят загрузку с основной: у каждого аккаунта
+# свой RateLimiter и свой бюджет одновременных загрузок. Сканирует основной аккаунт; file_id
+# привязан к аккаунту, поэтому остальные перечитывают сообщение через get_messages.
+# При долгом FloodWait, повторяющихся оборванных потоках или потере доступа к чату файл
+# передаётся другому аккаунту, а общий MediaIndex гарантирует, что каждый файл записывается один раз
+ACCESS_ERRORS = ()  # ошибки доступа pyrogram: заполняется в load_pyrogram
+
+class AccountUnavailable(Exception):
+    pass
+
+class Account:
+    def __init__(self, name: str, app, limiter: RateLimiter, workers: int, primary: bool = False,
+                 budget: bool = True):
+        self.name = name
+        self.app = app
+        self.limiter = limiter
+        self.workers = workers
+        self.primary = primary
+        # Без других аккаунтов бюджет не нужен: загрузки ограничены download_workers чата
+        self.slots = asyncio.Semaphore(workers) if budget else None
+        self.active = 0
+        self.downloaded = 0
+        self.blocked = set()  # чаты, к которым у аккаунта нет доступа
+
+    async def media_for(self, chat_id, rec: AudioRecord):
+        if self.primary:
+            return rec.file_id
+        msg = await self.limiter.call(self.app.get_messages, chat_id, rec.message_id)
+        media = media_of(msg) if msg is not None and not getattr(msg, "empty", False) else None
+        if media is None or getattr(media, "file_unique_id", None) != rec.file_unique_id:
+            raise AccountUnavailable(f"сообщение {rec.message_id} недоступно")
+        return media.file_id
+
+class AccountPool:
+    def __init__(self, accounts: list):
+        self.accounts = accounts
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    @property
+    def workers(self) -> int:
+        return sum(account.workers for account in self.accounts)
+
+    def pick(self, chat_id, exclude=()):
+        # Свободнее всего загруженный аккаунт с доступом к чату; аккаунты в FloodWait — последними
+        now = time.monotonic()
+        candidates = [a for a in self.accounts if a not in exclude and chat_id not in a.blocked]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda a: (a.limiter.flood_until > now, a.active / a.workers))
+
+    def snapshot(self) -> list:
+        return [{"account": a.name, "downloaded": a.downloaded, "active": a.active,
+                 "blocked_chats": len(a.blocked), **a.limiter.snapshot()} for a in self.accounts]
+
+def account_specs(cfg: dict) -> list:
+    specs = []
+    for spec in cfg.get("accounts") or []:
+        if isinstance(spec, str):
+            spec = {"session_name": spec}
+        if isinstance(spec, dict) and spec.get("session_name"):
+            specs.append(spec)
+        else:
+            logger.warning(f"Некорректная запись accounts: {spec!r}")
+    return specs
+
+@contextlib.asynccontextmanager
+async def open_accounts(cfg: dict, api_id: int, api_hash: str, exclude_session: str = None):
+    # Подключает дополнительные аккаунты из config; сессии без файла или с ошибкой входа пропускаются
+    accounts = []
+    try:
+        for spec in account_specs(cfg):
+            name = spec["session_name"]
+            if name == exclude_session:
+                continue
+            if not session_exists(name):
+                logger.warning(f"Аккаунт {name}: файл сессии не найден, выполните вход (TGmdown.py login --session {name})")
+                continue
+            try:
+                client = Client(name, api_id=int(spec.get("api_id") or api_id), api_hash=spec.get("api_hash") or api_hash,
+                                max_concurrent_transmissions=get_transmissions(dict(cfg, **spec)))
+                await client.start()
+            except Exception:
+                logger.exception(f"Аккаунт {name}: не удалось подключиться")
+                continue
+            accounts.append(Account(name, client, make_rate_limiter(spec), get_download_workers(spec)))
+            logger.info(f"Подключён дополнительный аккаунт {name}")
+        yield accounts
+    finally:
+        for account in accounts:
+            try:
+                await account.app.stop()
+            except Exception:
+                logger.exception(f"Ошибка отключения аккаунта {account.name}")
+
+# ====== Ядро: сканирование и скачивание без привязки к GUI ======
+def new_stats() -> dict:
+    return {"found": 0, "downloaded": 0, "skipped": 0, "duplicates": 0, "filtered": 0}
+
+async def get_chat_label(app, chat_id):
+    try:
+        chat = await app.get_chat(chat_id)
+        title = getattr(chat, "title", None) or getattr(chat, "first_name", None) or f"chat_{chat_id}"
+        uname = getattr(chat, "username", "") or ""
+        return f"{title} ({chat_id})" + (f" [@{uname}]" if uname else "")
+    except Exception:
+        return f"chat_{chat_id}"
+
+# Один прогон сканирования или скачивания одного чата. GUI и CLI передают сюда
+# колбэки прогресса (on_progress(job, percent)) и остановки (should_stop())
+class ChatJob:
+    def __init__(self, chat_id, download_folder: str, config: dict = None, full_rescan: bool = False,
+                 chat_label: str = None, on_progress=None, should_stop=None, message_ids: list = None):
+        self.chat_id = str(chat_id).strip()
+        self.message_ids = message_ids  # только эти сообщения (выбор из каталога)
+        self.download_folder = download_folder
+        self.config = config or {}
+        self.full_rescan = full_rescan
+        self.chat_label = chat_label
+        self.on_progress = on_progress
+        self.should_stop = should_stop or (lambda: False)
+        self.scan_filter = ScanFilter(self.config.get("filters"))
+        self.stats = new_stats()
+        self.errors = []
+        self.critical = False
+        self.since_id = 0
+        self.timestamp = datetime.now().strftime("%Y.%m.%d - %H_%M_%S")
+        self.report_file = None
+        self.error_file = None
+        self.manifest_file = None
+        self.percent = 0.0
+        self.metrics = TransferMetrics()
+
+    def progress(self, percent: float):
+        self.percent = percent
+        if self.on_progress:
+            self.on_progress(self, percent)
+
+    def mark_kind(self, command: str) -> str:
+        return f"{command}:{self.scan_filter.key}" if self.scan_filter else command
+
+    def open_manifest(self, folder: str, name: str) -> Manifest:
+        self.manifest_file = os.path.join(folder, f"{name}.{manifest_extension(self.config)}")
+        return Manifest(self.manifest_file, self.chat_id)
+
+    def fail(self, exc: Exception):
+        self.critical = True
+        self.errors.append(f"Critical: {exc}")
+
+    async def resolve_label(self, app) -> str:
+        if not self.chat_label:
+            self.chat_label = await get_chat_label(app, self.chat_id)
+        return sanitize_filename(self.chat_label)
+
+async def run_scan(app, job: ChatJob, limiter: RateLimiter = None, catalog: Catalog = None):
+    manifest = None
+    try:
+        safe_label = await job.resolve_label(app)
+        job.report_file = os.path.join(job.download_folder, f"{job.timestamp}_scan_report_{safe_label}.txt")
+        job.error_file = os.path.join(job.download_folder, f"{job.timestamp}_scan_errors_{safe_label}.txt")
+        manifest = job.open_manifest(job.download_folder, f"{job.timestamp}_scan_manifest_{safe_label}")
+        job.since_id = 0 if job.full_rescan else get_chat_mark(job.chat_id, job.mark_kind("scan"))
+
+        scanner = AudioScanner(app, job.chat_id, min_id=job.since_id, limiter=limiter or make_rate_limiter(job.config),
+                               scan_filter=job.scan_filter)
+        await scanner.count()
+        async for rec in scanner.iter_records():
+            if job.should_stop():
+                job.errors.append("Сканирование остановлено пользователем")
+                break
+            manifest.add(rec, "found")
+            if catalog is not None:
+                catalog.add(job.chat_id, job.chat_label, rec, "found")
+            job.stats["found"] += 1
+            job.stats["filtered"] = scanner.filtered
+            job.progress(scanner.progress())
+        else:
+            if scanner.top_id:
+                set_chat_mark(job.chat_id, job.mark_kind("scan"), scanner.top_id)
+        job.stats["filtered"] = scanner.filtered
+    except Exception as e:
+        logger.exception("Критическая ошибка во время сканирования")
+        job.fail(e)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+async def run_download(app, job: ChatJob, download_slots: asyncio.Semaphore = None, index: MediaIndex = None,
+                       limiter: RateLimiter = None, bandwidth: BandwidthLimiter = None, pool: AccountPool = None,
+                       source: "LiveAudioSource" = None, catalog: Catalog = None):
+    # source — источник записей вместо AudioScanner (наблюдение, выбор из каталога): он получает
+    # итог каждого файла (settle) и сам решает, двигать ли отметку download
+    manifest = None
+    try:
+        safe_label = await job.resolve_label(app)
+        chat_folder = os.path.join(job.download_folder, safe_label)
+        os.makedirs(chat_folder, exist_ok=True)
+        job.report_file = os.path.join(chat_folder, f"{job.timestamp}_downloaded_{safe_label}.txt")
+        job.error_file = os.path.join(chat_folder, f"{job.timestamp}_download_errors_{safe_label}.txt")
+        manifest = job.open_manifest(chat_folder, f"{job.timestamp}_download_manifest_{safe_label}")
+        job.since_id = 0 if job.full_rescan else get_chat_mark(job.chat_id, job.mark_kind("download"))
+        chat_id = job.chat_id
+        stats = job.stats
+
+        limiter = limiter or make_rate_limiter(job.config)
+        scanner = source or AudioScanner(app, chat_id, min_id=job.since_id, limiter=limiter, scan_filter=job.scan_filter)
+        await scanner.count()
+
+        # Конвейер: сканер кладёт записи в ограниченную очередь, пул из N
+        # воркеров поверх общего Client сразу их скачивает. Счётчики меняются
+        # только в потоке event loop, поэтому гонок между воркерами нет
+        pool = pool or AccountPool([Account("main", app, limiter, get_download_workers(job.config),
+                                            primary=True, budget=False)])
+        workers = pool.workers if len(pool) > 1 else get_download_workers(job.config)
+        own_index = index is None
+        if own_index:
+            index = MediaIndex(job.download_folder)
+        order = get_download_order(job.config)
+        if DOWNLOAD_ORDERS[order] is None:
+            queue = asyncio.Queue(maxsize=workers * QUEUE_PER_WORKER)
+        else:
+            queue = OrderedQueue(DOWNLOAD_ORDERS[order])
+        bandwidth = bandwidth or make_bandwidth_limiter(job.config)
+        range_threshold, range_streams = get_multirange_settings(job.config)
+        scan_complete = False
+        claimed_paths = set()
+        failed_ids = []
+        done = 0
+
+        async def transfer(rec, out_path, on_bytes) -> float:
+            # Скачивание через свободный аккаунт; при долгом FloodWait, повторяющихся оборванных потоках
+            # (ShortStream) или потере доступа файл переходит к следующему аккаунту и докачивается
+            # из того же .part. Возвращает время загрузки
+            tried = []
+            last_error = AccountUnavailable(f"нет аккаунта с доступом к чату {chat_id}")
+            while True:
+                account = pool.pick(chat_id, tried)
+                if account is None:
+                    raise last_error
+                handoff = ACCOUNT_HANDOFF_FLOOD if len(pool) - len(tried) > 1 else None
+                big = range_threshold and rec.size >= range_threshold
+                try:
+                    # download_slots — общий лимит загрузок на все чаты планировщика
+                    async with download_slots or contextlib.nullcontext(), account.slots or contextlib.nullcontext():
+                        account.active += 1
+                        try:
+                            started = time.monotonic()
+                            media = await account.media_for(chat_id, rec)
+                            await download_resumable(account.app, media, out_path, rec.size, job.should_stop,
+                                                     rec.file_unique_id, account.limiter, on_bytes, bandwidth, handoff,
+                                                     range_streams if big else 1)
+                        finally:
+                            account.active -= 1
+                    account.downloaded += 1
+                    return time.monotonic() - started
+                except (FloodWait, ShortStream, AccountUnavailable, *ACCESS_ERRORS) as e:
+                    if len(pool) - len(tried) <= 1:
+                        raise
+                    tried.append(account)
+                    last_error = e
+                    if not isinstance(e, (FloodWait, ShortStream)):
+                        account.blocked.add(chat_id)
+                    log_event(logging.WARNING, f"Аккаунт {account.name}: msg_id {rec.message_id} передан другому аккаунту ({e})",
+                              "handoff", chat_id=chat_id, message_id=rec.message_id, account=account.name, error=str(e))
+                    # Докачанное из .part уже учтено в метриках
+                    on_bytes = (lambda bytes_cb: lambda n, resumed: resumed or bytes_cb(n, resumed))(on_bytes)
+
+        async def download_one(rec) -> dict:
+            # Возвращает поля строки манифеста
+            uid = rec.file_unique_id
+            out_path = os.path.join(chat_folder, sanitize_filename(rec.file_name))
+            if not index.claim(uid):
+                stats["duplicates"] += 1
+                job.metrics.add_skipped(rec.size)
+                log_event(logging.INFO, f"Пропущен (duplicate): {uid} msg_id {rec.message_id}", "duplicate",
+                          chat_id=chat_id, message_id=rec.message_id, file_unique_id=uid)
+                return {"status": "duplicate"}
+            if out_path in claimed_paths or os.path.exists(out_path):
+                if out_path not in claimed_paths and is_complete_file(out_path, rec.size):
+                    # Файл скачан до появления индекса: то же имя и тот же размер
+                    index.add(uid, out_path, os.path.getsize(out_path), chat_id, rec.message_id)
+                    stats["duplicates"] += 1
+                    job.metrics.add_skipped(rec.size)
+                    log_event(logging.INFO, f"Пропущен (duplicate): {out_path}", "duplicate",
+                              chat_id=chat_id, message_id=rec.message_id, file_unique_id=uid, path=out_path)
+                    return {"status": "duplicate", "path": out_path}
+                out_path = numbered_path(out_path, rec.message_id)
+            claimed_paths.add(out_path)
+            received = 0
+
+            def on_bytes(n, resumed):
+                nonlocal received
+                received += n
+                job.metrics.add_bytes(n, resumed)
+                job.progress(progress())
+
+            try:
+                elapsed = await transfer(rec, out_path, on_bytes)
+            except BaseException as e:
+                index.release(uid)
+                claimed_paths.discard(out_path)
+                if isinstance(e, Exception) and not isinstance(e, DownloadCancelled):
+                    job.metrics.add_skipped(rec.size - received)
+                raise
+            job.metrics.add_file(elapsed)
+            index.add(uid, out_path, os.path.getsize(out_path), chat_id, rec.message_id)
+            stats["downloaded"] += 1
+            log_event(logging.INFO, f"Скачано: {out_path}", "downloaded", chat_id=chat_id,
+                      message_id=rec.message_id, path=out_path, size=rec.size, seconds=round(elapsed, 3))
+            return {"status": "downloaded", "path": out_path, "seconds": round(elapsed, 3)}
+
+        async def produce():
+            nonlocal scan_complete
+            try:
+                async for rec in scanner.iter_records():
+                    if job.should_stop():
+                        job.errors.append("Скачивание остановлено пользователем")
+                        break
+                    stats["found"] += 1
+                    stats["filtered"] = scanner.filtered
+                    job.metrics.add_expected(rec.size)
+                    await queue.put(rec)
+                else:
+                    scan_complete = True
+                stats["filtered"] = scanner.filtered
+            except Exception as e:
+                logger.exception("Критическая ошибка во время сканирования")
+                job.fail(e)
+            for _ in range(workers):
+                await queue.put(None)
+
+        def progress():
+            # По байтам, если размеры известны; размер ещё не найденных файлов
+            # оценивается по среднему размеру уже найденных
+            found = stats["found"]
+            expected = found if scan_complete or scanner.min_id else max(scanner.total, found)
+            if not expected:
+                return 0
+            metrics = job.metrics
+            if metrics.bytes_expected:
+                return min(100.0, metrics.bytes_settled / (metrics.bytes_expected * expected / found) * 100)
+            return done / expected * 100
+
+        async def worker():
+            nonlocal done
+            while True:
+                rec = await queue.get()
+                if rec is None or job.should_stop():
+                    return
+                try:
+                    entry = await download_one(rec)
+                except DownloadCancelled as e:
+                    log_event(logging.INFO, f"Скачивание прервано, частичный файл сохранён: {e}", "cancelled",
+                              chat_id=chat_id, message_id=rec.message_id, path=str(e))
+                    manifest.add(rec, "cancelled", path=str(e))
+                    return
+                except Exception as e:
+                    stats["skipped"] += 1
+                    failed_ids.append(rec.message_id)
+                    errtxt = f"Ошибка msg_id {rec.message_id}: {e}"
+                    job.errors.append(errtxt)
+                    log_event(logging.ERROR, errtxt, "failed", exc_info=True, chat_id=chat_id,
+                              message_id=rec.message_id, error=str(e))
+                    entry = {"status": "failed", "error": str(e)}
+                manifest.add(rec, **entry)
+                if catalog is not None:
+                    catalog.add(chat_id, job.chat_label, rec, entry["status"])
+                if source is not None:
+                    source.settle(rec, entry["status"])
+                done += 1
+                job.progress(progress())
+
+        logger.info(f"Скачивание: найдено на сервере {scanner.total}, потоков: {workers}, порядок: {order}, "
+                    f"в индексе: {len(index)}")
+        producer = asyncio.create_task(produce())
+        try:
+            await asyncio.gather(*(worker() for _ in range(workers)))
+        finally:
+            # Воркеры завершились по отмене — продюсер может ждать места в очереди
+            if not producer.done():
+                producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            if own_index:
+                index.close()
+
+        # Отметка сдвигается только до первого (с конца) неудачного сообщения,
+        # чтобы следующий прогон повторил его
+        if source is None and scan_complete and not job.should_stop() and scanner.top_id:
+            set_chat_mark(chat_id, job.mark_kind("download"), min(failed_ids) - 1 if failed_ids else scanner.top_id)
+    except Exception as e:
+        logger.exception("Критическая ошибка во время скачивания")
+        job.fail(e)
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+# ====== Режим наблюдения ======
+# Выбранные чаты скачиваются как при "Скачать" (от отметки download), после чего новые аудио
+# и голосовые приходят через обработчик обновлений Pyrogram и сразу попадают в очередь загрузки.
+# Пропущенное без связи добирается проходом по истории от отметки — после разрыва соединения
+# и раз в watch_gap_fill сек. (0 — только после разрыва); полного пересканирования нет
+class LiveAudioSource:
+    # Источник записей run_download для одного чата. Отметка сдвигается до границы последнего
+    # добора (всё не новее неё найдено), но не дальше первого неразобранного или неудачного
+    # сообщения: неудачные повторяются следующим добором
+    def __init__(self, app, job: ChatJob, min_id: int, limiter: RateLimiter):
+        self.app = app
+        self.job = job
+        self.limiter = limiter
+        self.filter = job.scan_filter
+        self.min_id = min_id  # отметка: всё не новее разобрано
+        self.saved_id = min_id
+        self.saved_at = 0.0
+        self.boundary = min_id
+        self.total = 0
+        self.top_id = 0
+        self.filtered = 0
+        self.seen = set()     # msg_id новее отметки, уже поставленные в очередь
+        self.pending = set()  # в очереди или качаются
+        self.failed = set()
+        self.queue = asyncio.Queue()
+        self.room = asyncio.Event()  # запись взята из очереди: добор может продолжить проход
+
+    async def count(self) -> int:
+        return 0
+
+    async def iter_records(self):
+        while True:
+            rec = await self.queue.get()
+            self.room.set()
+            if rec is None:
+                return
+            yield rec
+
+    def feed(self, msg):
+        self._put(AudioRecord.from_message(msg))
+
+    def _put(self, rec: AudioRecord) -> bool:
+        # True — запись поставлена в очередь загрузки
+        msg_id = rec.message_id
+        if msg_id <= self.min_id or msg_id in self.seen:
+            return False
+        self.seen.add(msg_id)
+        self.failed.discard(msg_id)
+        if not self.filter.match(rec):
+            self.filtered += 1
+            return False
+        self.pending.add(msg_id)
+        self.top_id = max(self.top_id, msg_id)
+        self.queue.put_nowait(rec)
+        return True
+
+    async def _wait_room(self):
+        while self.queue.qsize() >= WATCH_QUEUE_LIMIT and not self.job.should_stop():
+            self.room.clear()
+            try:
+                await asyncio.wait_for(self.room.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def gap_fill(self) -> int:
+        # Проход от отметки к новым сообщениям; возвращает число поставленных в очередь.
+        # Записи уходят в загрузку по мере чтения страниц, сообщения Pyrogram не накапливаются;
+        # при WATCH_QUEUE_LIMIT ждущих записей проход приостанавливается. Страницы идут от новых
+        # к старым, поэтому граница (всё не новее найдено) сдвигается, когда проход дошёл до отметки
+        scanner = AudioScanner(self.app, self.job.chat_id, min_id=self.min_id, limiter=self.limiter,
+                               scan_filter=self.filter)
+        queued = 0
+        async for msg in scanner.iter_messages():
+            if self.job.should_stop():
+                return queued
+            if self._put(AudioRecord.from_message(msg)):
+                queued += 1
+                await self._wait_room()
+        self.boundary = max(self.boundary, scanner.top_id)
+        self._advance()
+        return queued
+
+    def settle(self, rec: AudioRecord, status: str):
+        if status == "cancelled":
+            return
+        self.pending.discard(rec.message_id)
+        if status == "failed":
+            self.failed.add(rec.message_id)
+            self.seen.discard(rec.message_id)
+        self._advance()
+
+    def _advance(self, force: bool = False):
+        blocked = [msg_id for msg_id in self.pending | self.failed if msg_id <= self.boundary]
+        mark = min(blocked) - 1 if blocked else self.boundary
+        if mark > self.min_id:
+            self.min_id = mark
+            self.seen = {msg_id for msg_id in self.seen if msg_id > mark}
+        now = time.monotonic()
+        if self.min_id > self.saved_id and (force or now - self.saved_at >= WATCH_MARK_INTERVAL):
+            set_chat_mark(self.job.chat_id, self.job.mark_kind("download"), self.min_id)
+            self.saved_id, self.saved_at = self.min_id, now
+
+    def close(self):
+        self._advance(force=True)
+        self.queue.put_nowait(None)
+
+class ChatWatcher:
+    def __init__(self, app, jobs: list, limiter: RateLimiter, config: dict):
+        self.app = app
+        self.jobs = jobs
+        self.limiter = limiter
+        self.gap_interval = get_int_setting(config, "watch_gap_fill", DEFAULT_WATCH_GAP_FILL, lo=0, hi=86400)
+        self.sources = {}  # chat_id задания -> LiveAudioSource
+        self.by_chat = {}  # числовой id чата из обновлений -> LiveAudioSource
+        self.handlers = []
+        self.disconnected = False
+
+    def stopped(self) -> bool:
+        return all(job.should_stop() for job in self.jobs)
+
+    async def start(self):
+        from pyrogram import filters
+        from pyrogram.handlers import MessageHandler, DisconnectHandler
+        for job in self.jobs:
+            mark = 0 if job.full_rescan else get_chat_mark(job.chat_id, job.mark_kind("download"))
+            source = LiveAudioSource(self.app, job, mark, self.limiter)
+            chat = await self.limiter.call(self.app.get_chat, job.chat_id)
+            self.sources[job.chat_id] = source
+            self.by_chat[chat.id] = source
+        self.handlers = [(MessageHandler(self._on_message, filters.chat(list(self.by_chat)) &
+                                         (filters.audio | filters.voice)), WATCH_HANDLER_GROUP),
+                         (DisconnectHandler(self._on_disconnect), WATCH_HANDLER_GROUP)]
+        for handler, group in self.handlers:
+            self.app.add_handler(handler, group)
+        logger.info(f"Наблюдение за чатами: {', '.join(self.sources)}")
+
+    async def _on_message(self, client, message):
+        source = self.by_chat.get(message.chat.id)
+        if source is not None and not self.stopped():
+            log_event(logging.INFO, f"Новое сообщение {message.id} в {message.chat.id}", "live_message",
+                      chat_id=message.chat.id, message_id=message.id)
+            source.feed(message)
+
+    async def _on_disconnect(self, client):
+        self.disconnected = True
+
+    async def gap_fill(self) -> bool:
+        ok = True
+        for chat_id, source in self.sources.items():
+            try:
+                queued = await source.gap_fill()
+                if queued:
+                    logger.info(f"Наблюдение {chat_id}: добрано сообщений {queued}")
+            except Exception as e:
+                ok = False
+                logger.warning(f"Наблюдение {chat_id}: добор не удался ({e}), повтор через {WATCH_RETRY_DELAY:.0f} с")
+        return ok
+
+    async def _wait(self, delay: float):
+        # До delay сек. (None — без ограничения); раньше — после разрыва соединения или остановки
+        deadline = time.monotonic() + delay if delay else None
+        while not self.stopped():
+            if self.disconnected:
+                self.disconnected = False
+                logger.info(f"Соединение прерывалось, добор через {WATCH_RECONNECT_DELAY:.0f} с")
+                await asyncio.sleep(WATCH_RECONNECT_DELAY)
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            await asyncio.sleep(1.0)
+
+    async def run(self):
+        try:
+            while not self.stopped():
+                ok = await self.gap_fill()
+                await self._wait(self.gap_interval if ok else WATCH_RETRY_DELAY)
+        finally:
+            self.stop()
+
+    def stop(self):
+        for handler, group in self.handlers:
+            try:
+                self.app.remove_handler(handler, group)
+            except Exception:
+                logger.exception("Ошибка снятия обработчика обновлений")
+        self.handlers = []
+        for source in self.sources.values():
+            source.close()
+
+def filter_report_lines(job: ChatJob) -> list:
+    if not job.scan_filter:
+        return []
+    return [f"Фильтры: {json.dumps(job.scan_filter.spec, ensure_ascii=False)}",
+            f"Отфильтровано: {job.stats['filtered']}"]
+
+def write_scan_report(job: ChatJob):
+    if not job.report_file:
+        return
+    try:
+        with open(job.report_file, "w", encoding="utf-8") as rf:
+            header = [
+                "=== Отчёт о сканировании ===",
+                f"Чат: {job.chat_label}",
+                f"Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+                f"Сообщения новее msg_id: {job.since_id}" if job.since_id else "Полное сканирование",
+                f"Всего найдено: {job.stats['found']}",
+                f"Скачано: {job.stats['downloaded']}",
+                f"Пропущено: {job.stats['skipped']}",
+                f"Повторов: {job.stats['duplicates']}",
+                *filter_report_lines(job),
+                "="*30
+            ]
+            rf.write("\n".join(header)+"\n")
+            for row in read_manifest(job.manifest_file):
+                try:
+                    rf.write(f"{row['file_name']} | message_id: {row['message_id']} | duration: {row['duration']}s | date: {row['date']}\n")
+                except Exception as e:
+                    logger.exception(f"Ошибка записи строки отчёта msg {row.get('message_id')}: {e}")
+    except Exception as e:
+        logger.exception(f"Не удалось записать файл отчёта: {e}")
+
+def write_download_report(job: ChatJob):
+    if not job.report_file:
+        return
+    try:
+        with open(job.report_file, "w", encoding="utf-8") as rf:
+            header = [
+                "=== Отчёт о скачивании ===",
+                f"Чат: {job.chat_label} ({job.chat_id})",
+                f"Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+                f"Всего найдено: {job.stats['found']}",
+                f"Скачано: {job.stats['downloaded']}",
+                f"Пропущено: {job.stats['skipped']}",
+                f"Повторов: {job.stats['duplicates']}",
+                *filter_report_lines(job),
+                "="*30
+            ]
+            rf.write("\n".join(header)+"\n")
+            for row in read_manifest(job.manifest_file):
+                rf.write(f"{row['status']} | {row['file_name']} | message_id: {row['message_id']} | "
+                         f"{row['error'] or row['path']}\n")
+    except Exception:
+        logger.exception("Не удалось записать файл отчёта скачивания")
+
+def write_error_file(job: ChatJob):
+    if not job.errors or not job.error_file:
+        return
+    try:
+        with open(job.error_file, "w", encoding="utf-8") as ef:
+            for err in job.errors:
+                ef.write(err+"\n")
+    except Exception:
+        logger.exception("Не удалось записать файл ошибок")
+
+# ====== Планировщик нескольких чатов ======
+# Запускает сканирование или скачивание нескольких чатов одновременно на одном клиенте.
+# Лимиты: max_parallel_chats — чатов в работе, max_total_downloads — загрузок на все чаты,
+# download_workers — загрузок в одном чате; max_bandwidth — скорость всех загрузок вместе. Если задан metrics_file, сводные метрики
+# перезаписываются в него каждые METRICS_INTERVAL сек.
+class JobScheduler:
+    def __init__(self, jobs: list, config: dict = None, limiter: RateLimiter = None):
+        config = config or {}
+        self.jobs = jobs
+        self.config = config
+        self.pool = None
+        self.limiter = limiter or make_rate_limiter(config)
+        self.bandwidth = make_bandwidth_limiter(config)
+        self.metrics = TransferMetrics()
+        for job in jobs:
+            job.metrics.parent = self.metrics
+        self.metrics_file = config.get("metrics_file") or None
+        self.max_chats = get_int_setting(config, "max_parallel_chats", DEFAULT_PARALLEL_CHATS)
+        self.max_downloads = get_int_setting(config, "max_total_downloads", DEFAULT_TOTAL_DOWNLOADS,
+                                             hi=MAX_DOWNLOAD_WORKERS * 4)
+
+    async def run(self, app, command: str, accounts: list = ()):
+        # accounts — подключённые дополнительные аккаунты (open_accounts) для загрузки
+        chat_slots = asyncio.Semaphore(self.max_chats)
+        download_slots = asyncio.Semaphore(self.max_downloads)
+        # Один индекс на все чаты: репост того же трека в другом канале не качается повторно
+        index = MediaIndex(self.jobs[0].download_folder) if command in ("download", "watch") and self.jobs else None
+        catalog = Catalog(self.jobs[0].download_folder) if self.jobs else None
+        self.pool = AccountPool([Account(getattr(app, "name", None) or "main", app, self.limiter,
+                                         get_download_workers(self.config), primary=True, budget=bool(accounts))]
+                                + list(accounts))
+
+        watcher = ChatWatcher(app, self.jobs, self.limiter, self.config) if command == "watch" else None
+
+        async def run_one(job):
+            # Наблюдение длится до остановки: лимит max_parallel_chats к нему не применяется
+            async with chat_slots if watcher is None else contextlib.nullcontext():
+                if job.should_stop():
+                    return
+                logger.info(f"Планировщик: {command} {job.chat_id}")
+                if command == "scan":
+                    await run_scan(app, job, self.limiter, catalog)
+                    return
+                if watcher is not None:
+                    source = watcher.sources[job.chat_id]
+                elif job.message_ids:
+                    source = SelectedMessagesSource(app, job.chat_id, job.message_ids, self.limiter)
+                else:
+                    source = None
+                await run_download(app, job, download_slots, index, self.limiter, self.bandwidth, self.pool,
+                                   source, catalog)
+
+        async def export_metrics():
+            while True:
+                await asyncio.sleep(METRICS_INTERVAL)
+                self.export_metrics()
+
+        exporter = asyncio.create_task(export_metrics()) if self.metrics_file else None
+        watching = None
+        try:
+            if watcher is not None:
+                await watcher.start()
+                watching = asyncio.create_task(watcher.run())
+            await asyncio.gather(*(run_one(job) for job in self.jobs))
+        finally:
+            if watching is not None:
+                watching.cancel()
+                await asyncio.gather(watching, return_exceptions=True)
+            if exporter is not None:
+                exporter.cancel()
+                self.export_metrics()
+            if index is not None:
+                index.close()
+            if catalog is not None:
+                catalog.close()
+
+    def totals(self) -> dict:
+        total = new_stats()
+        for job in self.jobs:
+            for key, value in job.stats.items():
+                total[key] += value
+        return total
+
+    def percent(self) -> float:
+        return sum(job.percent for job in self.jobs) / len(self.jobs) if self.jobs else 0.0
+
+    def metrics_snapshot(self) -> dict:
+        snap = self.metrics.snapshot(self.limiter)
+        if self.pool is not None and len(self.pool) > 1:
+            snap["accounts"] = self.pool.snapshot()
+        return snap
+
+    def export_metrics(self):
+        if self.metrics_file:
+            write_metrics_file(self.metrics_file, self.metrics_snapshot(), self.jobs)
+
+    def write_reports(self, command: str):
+        for job in self.jobs:
+            if command == "scan":
+                write_scan_report(job)
+            else:
+                write_download_report(job)
+            write_error_file(job)
+
+# ====== Пакетный режим (CLI) ======
+CLI_COMMANDS = ("scan", "download", "watch", "catalog", "dedup", "login")
+EXIT_OK = 0
+EXIT_ITEM_ERRORS = 1   # прогон завершён, но часть файлов не скачана
+EXIT_USAGE = 2         # неверные аргументы или настройки
+EXIT_FAILURE = 3       # критическая ошибка (нет соединения, чат недоступен)
+EXIT_INTERRUPTED = 130
+CLI_PROGRESS_INTERVAL = 1.0  # сек. между строками прогресса
+
+def emit_event(event: str, **fields):
+    # Одна JSON-строка на событие в stdout — для разбора скриптами и cron
+    fields["event"] = event
+    fields["time"] = datetime.now().isoformat(timespec="seconds")
+    print(json.dumps(fields, ensure_ascii=False), flush=True)
+
+def build_cli_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog="TGmdown.py",
+                                     description="Telegram Music Downloader: пакетный режим без GUI. "
+                                                 "Без аргументов запускается графический интерфейс.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("scan", "Сканировать аудио в чате и записать отчёт"),
+                            ("download", "Скачать аудио из чата"),
+                            ("watch", "Скачать аудио из чата и дальше качать новые до Ctrl+C")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--chat", required=True, nargs="+",
+                       help="ID или @username чата; можно несколько через пробел или запятую")
+        p.add_argument("--config", default=CONFIG_FILE, help="Путь к config.json (по умолчанию %(default)s)")
+        p.add_argument("--auth", default=AUTH_FILE, help="Путь к auth.txt, если в config нет API_ID/API_HASH")
+        p.add_argument("--session", help="Имя сессии (по умолчанию из config)")
+        p.add_argument("--folder", help="Папка для загрузки (по умолчанию из config)")
+        p.add_argument("--workers", type=int, help="Число одновременных загрузок")
+        p.add_argument("--full-rescan", action="store_true", help="Игнорировать отметку прошлого прогона")
+        p.add_argument("--metrics-file", help="Периодически перезаписываемый файл метрик (.json или .prom)")
+        p.add_argument("--order", choices=tuple(DOWNLOAD_ORDERS), help="Порядок загрузки (по умолчанию newest)")
+        p.add_argument("--max-bandwidth", type=float, help="Общий лимит скорости, МБ/с (0 — без ограничения)")
+        g = p.add_argument_group("фильтры (дополняют \"filters\" из config.json)")
+        g.add_argument("--date-from", dest="date_from", help="Не старше даты ГГГГ-ММ-ДД")
+        g.add_argument("--date-to", dest="date_to", help="Не новее даты ГГГГ-ММ-ДД (включительно)")
+        g.add_argument("--min-size", dest="min_size_mb", type=float, help="Минимальный размер, МБ")
+        g.add_argument("--max-size", dest="max_size_mb", type=float, help="Максимальный размер, МБ")
+        g.add_argument("--min-duration", dest="min_duration", type=float, help="Минимальная длительность, сек.")
+        g.add_argument("--max-duration", dest="max_duration", type=float, help="Максимальная длительность, сек.")
+        g.add_argument("--kind", choices=("all", "audio", "voice"), help="Только музыка или только голосовые")
+        g.add_argument("--mime", help="MIME-типы и/или расширения через запятую: audio/flac,.mp3")
+        g.add_argument("--performer", help="Регулярное выражение для исполнителя")
+        g.add_argument("--title", help="Регулярное выражение для названия")
+        g.add_argument("--name", dest="file_name", help="Регулярное выражение для имени файла")
+    p = sub.add_parser("catalog", help="Искать в каталоге найденных аудио; --download ставит результаты в загрузку")
+    p.add_argument("query", nargs="*", help="Слова из исполнителя, названия или имени файла (начала слов)")
+    p.add_argument("--chat", nargs="+", help="Только эти чаты (ID или @username, как при сканировании)")
+    p.add_argument("--kind", choices=("audio", "voice"), help="Только музыка или только голосовые")
+    p.add_argument("--limit", type=int, default=CATALOG_LIMIT, help="Строк в результате (по умолчанию %(default)s)")
+    p.add_argument("--download", action="store_true", help="Скачать найденное")
+    p.add_argument("--config", default=CONFIG_FILE, help="Путь к config.json (по умолчанию %(default)s)")
+    p.add_argument("--auth", default=AUTH_FILE, help="Путь к auth.txt, если в config нет API_ID/API_HASH")
+    p.add_argument("--session", help="Имя сессии (по умолчанию из config)")
+    p.add_argument("--folder", help="Папка загрузки с каталогом (по умолчанию из config)")
+    p.add_argument("--workers", type=int, help="Число одновременных загрузок")
+    p = sub.add_parser("login", help="Войти в аккаунт и добавить его в accounts для загрузки")
+    p.add_argument("--session", required=True, help="Имя сессии дополнительного аккаунта")
+    p.add_argument("--config", default=CONFIG_FILE, help="Путь к config.json (по умолчанию %(default)s)")
+    p.add_argument("--auth", default=AUTH_FILE, help="Путь к auth.txt, если в config нет API_ID/API_HASH")
+    p = sub.add_parser("dedup", help="Заменить одинаковые файлы библиотеки жёсткими ссылками")
+    p.add_argument("--config", default=CONFIG_FILE, help="Путь к config.json (по умолчанию %(default)s)")
+    p.add_argument("--folder", help="Папка библиотеки (по умолчанию из config)")
+    p.add_argument("--workers", type=int, help="Число процессов хэширования")
+    p.add_argument("--dry-run", action="store_true", help="Только посчитать, файлы не менять")
+    return parser
+
+def get_hash_workers(cfg: dict) -> int:
+    return get_int_setting(cfg, "hash_workers", os.cpu_count() or 1)
+
+def cli_catalog_search(args, folder: str) -> list:
+    # Строки результата — события "result"; итог с временем запроса — "found"
+    started = time.perf_counter()
+    rows = search_catalog(folder, " ".join(args.query), parse_chat_ids(",".join(args.chat or [])), args.kind,
+                          args.limit)
+    for row in rows:
+        emit_event("result", **row)
+    emit_event("found", command="catalog", results=len(rows),
+               elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+    return rows
+
+def cli_catalog(args) -> int:
+    cfg = load_config(args.config)
+    folder = args.folder or cfg.get("download_folder") or default_download_folder()
+    if not os.path.exists(os.path.join(folder, INDEX_FILE)):
+        emit_event("error", message=f"Каталог в {folder} не найден: сначала выполните scan")
+        return EXIT_USAGE
+    try:
+        cli_catalog_search(args, folder)
+    except sqlite3.Error as e:
+        logger.exception("Ошибка поиска в каталоге")
+        emit_event("error", message=str(e))
+        return EXIT_FAILURE
+    return EXIT_OK
+
+def cli_login(args) -> int:
+    # Интерактивный вход (код из Telegram вводится в консоли); сессия регистрируется в "accounts"
+    cfg = load_config(args.config)
+    auth = parse_auth_file(args.auth)
+    try:
+        api_id = int(cfg.get("api_id") or auth.get("api_id"))
+        api_hash = cfg.get("api_hash") or auth.get("api_hash")
+    except (TypeError, ValueError):
+        api_hash = None
+    if not api_hash:
+        emit_event("error", message="API_ID и API_HASH не заданы ни в config, ни в auth.txt")
+        return EXIT_USAGE
+
+    async def login():
+        load_pyrogram()
+        async with Client(args.session, api_id=api_id, api_hash=api_hash,
+                          max_concurrent_transmissions=get_transmissions(cfg)) as app:
+            return await app.get_me()
+
+    try:
+        me = asyncio.run(login())
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        logger.exception("Ошибка входа")
+        emit_event("error", message=str(e))
+        return EXIT_FAILURE
+    registered = False
+    if args.session != cfg.get("session_name") and args.session not in {s["session_name"] for s in account_specs(cfg)}:
+        cfg.setdefault("accounts", []).append({"session_name": args.session})
+        save_config(cfg, args.config)
+        registered = True
+    emit_event("done", command="login", session=args.session, user=getattr(me, "first_name", None), registered=registered)
+    return EXIT_OK
+
+def cli_dedup(args) -> int:
+    cfg = load_config(args.config)
+    if args.workers is not None:
+        cfg["hash_workers"] = args.workers
+    folder = args.folder or cfg.get("download_folder") or default_download_folder()
+    if not os.path.isdir(folder):
+        emit_event("error", message=f"Папка не найдена: {folder}")
+        return EXIT_USAGE
+    emit_event("start", command="dedup", folder=folder, dry_run=args.dry_run)
+
+    last_emit = 0.0
+    def on_progress(done, total):
+        nonlocal last_emit
+        now = time.monotonic()
+        if now - last_emit >= CLI_PROGRESS_INTERVAL or done == total:
+            last_emit = now
+            emit_event("progress", command="dedup", hashed=done, total=total)
+
+    try:
+        summary = dedup_library(folder, get_hash_workers(cfg), args.dry_run, on_progress)
+    except KeyboardInterrupt:
+        emit_event("interrupted", command="dedup")
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        logger.exception("Ошибка дедупликации")
+        emit_event("error", message=str(e))
+        return EXIT_FAILURE
+    code = EXIT_ITEM_ERRORS if summary["errors"] else EXIT_OK
+    emit_event("done", command="dedup", exit_code=code, dry_run=args.dry_run, **summary)
+    return code
+
+def cli_settings(args):
+    # Настройки из config.json с переопределением аргументами; auth.txt — запасной источник ключей
+    cfg = load_config(args.config)
+    auth = parse_auth_file(args.auth)
+    api_id = cfg.get("api_id") or auth.get("api_id")
+    api_hash = cfg.get("api_hash") or auth.get("api_hash")
+    session_name = args.session or cfg.get("session_name") or "telegram_music"
+    folder = args.folder or cfg.get("download_folder") or default_download_folder()
+    if args.workers is not None:
+        cfg["download_workers"] = args.workers
+    if getattr(args, "metrics_file", None):
+        cfg["metrics_file"] = args.metrics_file
+    if getattr(args, "order", None):
+        cfg["download_order"] = args.order
+    if getattr(args, "max_bandwidth", None) is not None:
+        cfg["max_bandwidth"] = args.max_bandwidth
+    cfg["filters"] = cli_filter_spec(args, cfg)
+    ScanFilter(cfg["filters"])  # ValueError при некорректных фильтрах
+    if not api_id or not api_hash:
+        raise ValueError("API_ID и API_HASH не заданы ни в config, ни в auth.txt")
+    try:
+        api_id = int(api_id)
+    except (TypeError, ValueError):
+        raise ValueError("API ID должно быть числом")
+    return cfg, session_name, api_id, api_hash, folder
+
+def cli_main(argv) -> int:
+    args = build_cli_parser().parse_args(argv)
+    setup_logging(load_config(args.config))
+    logger.info(f"Запуск приложения: {args.command}")
+    if args.command == "dedup":
+        return cli_dedup(args)
+    if args.command == "login":
+        return cli_login(args)
+    if args.command == "catalog" and not args.download:
+        return cli_catalog(args)
+    try:
+        cfg, session_name, api_id, api_hash, folder = cli_settings(args)
+    except ValueError as e:
+        emit_event("error", message=str(e))
+        return EXIT_USAGE
+    os.makedirs(folder, exist_ok=True)
+    # catalog --download — скачивание выбранных в каталоге сообщений
+    command = "download" if args.command == "catalog" else args.command
+    selection = {}
+    if args.command == "catalog":
+        try:
+            selection = catalog_selection(cli_catalog_search(args, folder))
+        except sqlite3.Error as e:
+            logger.exception("Ошибка поиска в каталоге")
+            emit_event("error", message=str(e))
+            return EXIT_FAILURE
+        if not selection:
+            return EXIT_OK
+
+    last_emit = 0.0
+    def on_progress(job, percent):
+        nonlocal last_emit
+        now = time.monotonic()
+        if now - last_emit >= CLI_PROGRESS_INTERVAL:
+            last_emit = now
+            metrics = job.metrics
+            eta = metrics.eta()
+            emit_event("progress", command=command, chat_id=job.chat_id, percent=round(percent, 1),
+                       bytes=metrics.bytes_done + metrics.bytes_resumed, bytes_expected=metrics.bytes_expected,
+                       speed=round(metrics.speed()), eta=None if eta is None else round(eta), **job.stats)
+
+    chat_ids = list(selection) if selection else parse_chat_ids(",".join(args.chat))
+    jobs = [ChatJob(cid, folder, cfg, full_rescan=getattr(args, "full_rescan", False), on_progress=on_progress,
+                    message_ids=selection.get(cid)) for cid in chat_ids]
+    scheduler = JobScheduler(jobs, cfg)
+    emit_event("start", command=command, chats=chat_ids, folder=folder)
+
+    async def run():
+        load_pyrogram()
+        try:
+            async with Client(session_name, api_id=api_id, api_hash=api_hash,
+                              max_concurrent_transmissions=get_transmissions(cfg)) as app:
+                extra = (open_accounts(cfg, api_id, api_hash, session_name) if command in ("download", "watch")
+                         else contextlib.nullcontext([]))
+                async with extra as accounts:
+                    await scheduler.run(app, command, accounts)
+        except Exception as e:
+            logger.exception("Критическая ошибка в пакетном режиме")
+            for job in jobs:
+                job.fail(e)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("Пакетный режим прерван пользователем")
+        emit_event("interrupted", command=command, **scheduler.totals())
+        # Для наблюдения Ctrl+C — обычное завершение: отчёты пишутся как после скачивания
+        if command != "watch":
+            return EXIT_INTERRUPTED
+    scheduler.write_reports(command)
+
+    code = EXIT_OK
+    for job in jobs:
+        job_code = EXIT_FAILURE if job.critical else (EXIT_ITEM_ERRORS if job.stats["skipped"] else EXIT_OK)
+        code = max(code, job_code)
+        emit_event("chat_done", command=command, chat_id=job.chat_id, chat=job.chat_label, exit_code=job_code,
+                   report=job.report_file, manifest=job.manifest_file, errors=len(job.errors), **job.stats)
+    if command == "download" and cfg.get("dedup_after_download"):
+        try:
+            emit_event("dedup", **dedup_library(folder, get_hash_workers(cfg)))
+        except Exception as e:
+            logger.exception("Ошибка дедупликации после скачивания")
+            emit_event("error", message=f"Дедупликация: {e}")
+    emit_event("done", command=command, chats=len(jobs), exit_code=code, metrics=scheduler.metrics_snapshot(),
+               **scheduler.totals())
+    return code
+
+# ====== Виртуальный список ======
+# Listbox, в котором отрисованы только видимые строки: для тысяч чатов вставка и
+# фильтрация не создают тысячи элементов Tk. Выделение хранится по ключам модели
+class VirtualListbox:
+    def __init__(self, parent, on_select=None, **listbox_options):
+        self.items = []  # [(key, text)]
+        self.selected = set()
+        self.first = 0
+        self.on_select = on_select
+        self._extend = False
+        self._line = None
+        self.listbox = tk.Listbox(parent, selectmode=tk.EXTENDED, exportselection=False, **listbox_options)
+        self.scrollbar = tk.Scrollbar(parent, command=self._on_scrollbar)
+        self.listbox.pack(side="left", fill="both", expand=True, pady=4)
+        self.scrollbar.pack(side="right", fill="y")
+        self.listbox.bind("<<ListboxSelect>>", self._on_listbox_select)
+        self.listbox.bind("<ButtonPress-1>", self._on_press)
+        self.listbox.bind("<Configure>", lambda e: self.render())
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units"))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll(-1, "units"))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll(1, "units"))
+
+    def rows(self) -> int:
+        if self._line is None:
+            self._line = tk.font.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        height = self.listbox.winfo_height()
+        return max(1, height // self._line) if height > 1 else int(self.listbox.cget("height"))
+
+    def set_items(self, items: list):
+        self.items = items
+        keys = {key for key, _ in items}
+        self.selected &= keys
+        self.first = 0
+        self.render()
+
+    def render(self):
+        rows = self.rows()
+        self.first = max(0, min(self.first, len(self.items) - rows))
+        visible = self.items[self.first:self.first + rows]
+        self.listbox.delete(0, tk.END)
+        for row, (key, text) in enumerate(visible):
+            self.listbox.insert(tk.END, text)
+            if key in self.selected:
+                self.listbox.selection_set(row)
+        total = len(self.items) or 1
+        self.scrollbar.set(self.first / total, min(1.0, (self.first + rows) / total))
+
+    def scroll(self, amount, what="units"):
+        step = self.rows() if what == "pages" else 3
+        self.first += int(amount) * step
+        self.render()
+        return "break"
+
+    def _on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.first = int(float(args[0]) * len(self.items))
+            self.render()
+        elif action == "scroll":
+            self.scroll(int(args[0]), args[1])
+
+    def _on_press(self, event):
+        # Shift/Ctrl — добавить к выделению, в том числе к строкам вне экрана
+        self._extend = bool(event.state & 0x0005)
+
+    def _on_listbox_select(self, event):
+        visible = self.items[self.first:self.first + self.listbox.size()]
+        picked = {visible[row][0] for row in self.listbox.curselection() if row < len(visible)}
+        if self._extend:
+            self.selected -= {key for key, _ in visible}
+            self.selected |= picked
+        else:
+            self.selected = picked
+        if self.on_select:
+            self.on_select(self.selected_keys())
+
+    def selected_keys(self) -> list:
+        return [key for key, _ in self.items if key in self.selected]
+
+    def clear(self):
+        self.selected.clear()
+        self.set_items([])
+
+# ====== Окно каталога ======
+# Поиск идёт в потоке Tk: запрос к FTS занимает миллисекунды, ввод лишь откладывается на CATALOG_TYPE_DELAY
+CATALOG_TYPE_DELAY = 200
+CATALOG_COLUMNS = (("chat", "Чат", 140), ("performer", "Исполнитель", 150), ("title", "Название", 200),
+                   ("file", "Файл", 170), ("duration", "Длит.", 60), ("size", "Размер", 80),
+                   ("date", "Дата", 130), ("status", "Статус", 90))
+CATALOG_STATUS_LABELS = {"found": "найден", "downloaded": "скачан", "duplicate": "повтор",
+                         "failed": "ошибка", "cancelled": "отменён"}
+
+class CatalogWindow:
+    def __init__(self, parent, folder: str, on_download=None):
+        self.folder = folder
+        self.on_download = on_download
+        self.rows = {}  # iid -> строка каталога
+        self._pending = None
+        self.win = tk.Toplevel(parent)
+        self.win.title("Каталог аудио")
+        self.win.geometry("1060x520")
+
+        search_frame = tk.Frame(self.win, padx=6, pady=4)
+        search_frame.pack(fill="x")
+        tk.Label(search_frame, text="Поиск:").pack(side="left")
+        self.query_var = tk.StringVar()
+        self.query_var.trace_add("write", lambda *_: self.schedule_search())
+        entry = tk.Entry(search_frame, textvariable=self.query_var, width=50)
+        entry.pack(side="left", fill="x", expand=True, padx=4)
+        entry.focus_set()
+        self.kind_labels = {"Все": None, "Музыка": "audio", "Голосовые": "voice"}
+        self.kind_var = tk.StringVar(value="Все")
+        kind_box = ttk.Combobox(search_frame, textvariable=self.kind_var, values=list(self.kind_labels),
+                                state="readonly", width=10)
+        kind_box.pack(side="left", padx=4)
+        kind_box.bind("<<ComboboxSelected>>", lambda e: self.search())
+
+        table_frame = tk.Frame(self.win, padx=6)
+        table_frame.pack(fill="both", expand=True)
+        self.tree = ttk.Treeview(table_frame, columns=[c for c, _, _ in CATALOG_COLUMNS], show="headings")
+        for column, title, width in CATALOG_COLUMNS:
+            self.tree.heading(column, text=title)
+            self.tree.column(column, width=width, anchor="w")
+        scrollbar = tk.Scrollbar(table_frame, command=self.tree.yview)
+        self.tree.config(yscrollcommand=scrollbar.set)
+        self.tree.pack(side="left", fill="both", expand=True, pady=4)
+        scrollbar.pack(side="right", fill="y")
+
+        bottom_frame = tk.Frame(self.win, padx=6, pady=4)
+        bottom_frame.pack(fill="x")
+        self.info_label = tk.Label(bottom_frame, text="", fg="gray", anchor="w")
+        self.info_label.pack(side="left", fill="x", expand=True)
+        tk.Button(bottom_frame, text="Скачать выбранные", width=22, command=self.download_selected).pack(side="right")
+        self.search()
+
+    def schedule_search(self):
+        if self._pending is not None:
+            self.win.after_cancel(self._pending)
+        self._pending = self.win.after(CATALOG_TYPE_DELAY, self.search)
+
+    def search(self):
+        self._pending = None
+        started = time.perf_counter()
+        try:
+            rows = search_catalog(self.folder, self.query_var.get(), kind=self.kind_labels.get(self.kind_var.get()))
+        except sqlite3.Error as e:
+            logger.exception("Ошибка поиска в каталоге")
+            self.info_label.config(text=f"Ошибка поиска: {e}")
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        self.tree.delete(*self.tree.get_children())
+        self.rows = {}
+        for row in rows:
+            date = datetime.fromtimestamp(row["date"]).strftime('%Y-%m-%d %H:%M') if row["date"] else ""
+            values = (row["chat_label"] or row["chat_id"], row["performer"] or "", row["title"] or "",
+                      row["file_name"] or "", format_duration(row["duration"]), format_bytes(row["size"] or 0), date,
+                      CATALOG_STATUS_LABELS.get(row["status"], row["status"] or ""))
+            self.rows[self.tree.insert("", "end", values=values)] = row
+        more = " (показаны первые)" if len(rows) >= CATALOG_LIMIT else ""
+        self.info_label.config(text=f"Найдено: {len(rows)}{more} | {elapsed:.0f} мс")
+
+    def download_selected(self):
+        rows = [self.rows[iid] for iid in self.tree.selection() if iid in self.rows]
+        if not rows:
+            messagebox.showerror("Ошибка", "Выберите строки для скачивания", parent=self.win)
+            return
+        if self.on_download:
+            self.on_download(catalog_selection(rows))
+
 # ====== Основное приложение ======
 class TelegramMusicApp:
-    def __init__(self, root: tk.Tk):
+    def __init__(self, root: "tk.Tk", startup: "StartupTimer" = None):
         self.root = root
         self.root.title("Telegram Music Downloader v.r01")
         self.root.geometry("950x900")
+        self.startup = startup or StartupTimer()
 
         # ====== Конфиг и папка для скачивания ======
+        # Папка, auth.txt и файлы сессии проверяются после первой отрисовки (_deferred_init)
         self.config = load_config()
-        default_dl = os.path.join(os.path.expanduser("~"), "Music", "TelegramMusic")
-        self.download_folder = self.config.get("download_folder", default_dl)
-        os.makedirs(self.download_folder, exist_ok=True)
-
-        # ====== Подготовка auth.txt ======
-        create_auth_template(AUTH_FILE)
-        auth_values = parse_auth_file(AUTH_FILE)
+        self.download_folder = self.config.get("download_folder", default_download_folder())
 
         # ====== 1 блок: Поля ввода данных ======
         input_frame = tk.Frame(root, padx=6, pady=6, relief=tk.RIDGE, bd=2)
         input_frame.pack(fill="x", padx=6, pady=4)
         self.api_id_entry = self._make_labeled_entry_frame(input_frame, "API ID:",
                                                            "Получить можно в my.telegram.org",
-                                                           auth_values.get("api_id", self.config.get("api_id", "")),
+                                                           self.config.get("api_id", ""),
                                                            hidden=True)
         self.api_hash_entry = self._make_labeled_entry_frame(input_frame, "API Hash:",
                                                              "Получить можно в my.telegram.org",
-                                                             auth_values.get("api_hash", self.config.get("api_hash", "")),
+                                                             self.config.get("api_hash", ""),
                                                              hidden=True)
         self.session_name_entry = self._make_labeled_entry_frame(input_frame, "Имя сессии:",
                                                                  "Имя файла сессии для хранения авторизации",
                                                                  self.config.get("session_name", "telegram_music"))
         self.phone_entry = self._make_labeled_entry_frame(input_frame, "Номер телефона:",
                                                           "Номер Telegram-аккаунта",
-                                                          auth_values.get("phone_number", self.config.get("phone_number", "")),
+                                                          self.config.get("phone_number", ""),
                                                           hidden=True)
         self.chat_id_entry = self._make_labeled_entry_frame(input_frame, "ID выбранного чата:",
                                                             "ID группы/канала/чата",
@@ -246,12 +3148,16 @@ class TelegramMusicApp:
         list_frame = tk.Frame(root, padx=6, pady=4)
         list_frame.pack(fill="both", expand=True, padx=6, pady=4)
         tk.Label(list_frame, text="Список групп/каналов:").pack(anchor="w")
-        self.chat_listbox = tk.Listbox(list_frame, width=110, height=15)
-        self.chat_listbox.pack(side="left", fill="both", expand=True, pady=4)
-        self.chat_listbox.bind("<<ListboxSelect>>", self.on_chat_select)
-        chat_scroll = tk.Scrollbar(list_frame, command=self.chat_listbox.yview)
-        chat_scroll.pack(side="right", fill="y")
-        self.chat_listbox.config(yscrollcommand=chat_scroll.set)
+        tk.Label(list_frame, text="Ctrl/Shift — выбрать несколько чатов", fg="gray").pack(anchor="w")
+        filter_frame = tk.Frame(list_frame)
+        filter_frame.pack(fill="x")
+        tk.Label(filter_frame, text="Поиск:").pack(side="left")
+        self.chat_filter_var = tk.StringVar()
+        self.chat_filter_var.trace_add("write", lambda *_: self.apply_chat_filter())
+        tk.Entry(filter_frame, textvariable=self.chat_filter_var, width=40).pack(side="left", fill="x", expand=True)
+        self.chat_count_label = tk.Label(filter_frame, text="", fg="gray")
+        self.chat_count_label.pack(side="left", padx=4)
+        self.chat_listbox = VirtualListbox(list_frame, on_select=self.on_chat_select, width=110, height=15)
 
         # ====== 4 блок: Папка для загрузки ======
         folder_frame = tk.Frame(root, padx=6, pady=4)
@@ -260,12 +3166,62 @@ class TelegramMusicApp:
         self.folder_label = tk.Label(folder_frame, text=f"📂 Папка: {self.download_folder}", fg="gray", wraplength=900, anchor="w", justify="left")
         self.folder_label.pack(fill="x", pady=4)
 
+        # ====== Фильтры сканирования ======
+        filters_frame = tk.LabelFrame(root, text="Фильтры (пустое поле — без ограничения)", padx=6, pady=4)
+        filters_frame.pack(fill="x", padx=6, pady=4)
+        saved_filters = self.config.get("filters") or {}
+        self.filter_entries = {}
+        filter_fields = (
+            (0, "Дата с (ГГГГ-ММ-ДД):", "date_from", 12), (0, "по:", "date_to", 12),
+            (0, "Размер, МБ от:", "min_size_mb", 6), (0, "до:", "max_size_mb", 6),
+            (0, "Длительность, с от:", "min_duration", 6), (0, "до:", "max_duration", 6),
+            (1, "MIME/расширения:", "mime", 14), (1, "Исполнитель (regex):", "performer", 14),
+            (1, "Название (regex):", "title", 14), (1, "Имя файла (regex):", "file_name", 14),
+        )
+        columns = [0, 0]
+        for row, label, key, width in filter_fields:
+            tk.Label(filters_frame, text=label).grid(row=row, column=columns[row], sticky="e")
+            entry = tk.Entry(filters_frame, width=width)
+            entry.insert(0, str(saved_filters.get(key, "")))
+            entry.grid(row=row, column=columns[row] + 1, sticky="w", padx=(0, 6))
+            self.filter_entries[key] = entry
+            columns[row] += 2
+        tk.Label(filters_frame, text="Тип:").grid(row=1, column=columns[1], sticky="e")
+        self.filter_kind_labels = {"Все": "all", "Музыка": "audio", "Голосовые": "voice"}
+        kind_label = {v: k for k, v in self.filter_kind_labels.items()}.get(saved_filters.get("kind", "all"), "Все")
+        self.filter_kind_var = tk.StringVar(value=kind_label)
+        ttk.Combobox(filters_frame, textvariable=self.filter_kind_var, values=list(self.filter_kind_labels),
+                     state="readonly", width=10).grid(row=1, column=columns[1] + 1, sticky="w")
+
         # ====== 5 блок: Кнопки действий ======
         action_frame = tk.Frame(root, padx=6, pady=4)
         action_frame.pack(fill="x", padx=6, pady=4)
         self._make_button_with_help_frame(action_frame, "Считать группы/каналы", self.fetch_chats, "Подгрузка чатов")
         self._make_button_with_help_frame(action_frame, "Сканировать аудио (поток)", self.scan_audio_threaded, "Сканирование аудио")
         self._make_button_with_help_frame(action_frame, "Скачать аудио (поток)", self.download_audio_threaded, "Скачивание аудио")
+        self.full_rescan_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(action_frame, text="Полное пересканирование", variable=self.full_rescan_var).pack(side="left", padx=4)
+        extra_actions_frame = tk.Frame(root, padx=6)
+        extra_actions_frame.pack(fill="x", padx=6)
+        self._make_button_with_help_frame(extra_actions_frame, "Следить за новыми", self.watch_audio_threaded,
+                                          "Скачать аудио и дальше качать новые сразу после публикации (до ❌)")
+        self._make_button_with_help_frame(extra_actions_frame, "Каталог", self.open_catalog,
+                                          "Поиск по всем найденным при сканировании аудио; выбранные можно скачать")
+        self._make_button_with_help_frame(extra_actions_frame, "Убрать дубликаты", self.dedup_threaded, "Дедупликация")
+
+        options_frame = tk.Frame(root, padx=6)
+        options_frame.pack(fill="x", padx=6)
+        tk.Label(options_frame, text="Порядок загрузки:").pack(side="left")
+        self.order_labels = {"Сначала новые": "newest", "Сначала старые": "oldest",
+                             "Сначала мелкие": "smallest", "Короткие задачи (SJF)": "sjf"}
+        order_label = {v: k for k, v in self.order_labels.items()}[get_download_order(self.config)]
+        self.order_var = tk.StringVar(value=order_label)
+        ttk.Combobox(options_frame, textvariable=self.order_var, values=list(self.order_labels),
+                     state="readonly", width=22).pack(side="left", padx=4)
+        tk.Label(options_frame, text="Лимит скорости, МБ/с (0 — без лимита):").pack(side="left", padx=(12, 0))
+        self.bandwidth_entry = tk.Entry(options_frame, width=8)
+        self.bandwidth_entry.insert(0, str(self.config.get("max_bandwidth", 0)))
+        self.bandwidth_entry.pack(side="left", padx=4)
 
         # ====== 6 блок: Статус и прогресс ======
         progress_frame = tk.Frame(root, padx=6, pady=4, relief=tk.GROOVE, bd=2)
@@ -274,6 +3230,10 @@ class TelegramMusicApp:
         self.status_label.pack(fill="x", pady=2)
         self.stats_label = tk.Label(progress_frame, text="Найдено: 0 | Скачано: 0 | Пропущено: 0 | Повторов: 0", anchor="w")
         self.stats_label.pack(fill="x", pady=2)
+        self.metrics_label = tk.Label(progress_frame, text="", anchor="w")
+        self.metrics_label.pack(fill="x")
+        self.jobs_label = tk.Label(progress_frame, text="", anchor="w", justify="left", fg="gray")
+        self.jobs_label.pack(fill="x")
         self.progress_var = tk.DoubleVar()
         self.progress_bar = ttk.Progressbar(progress_frame, length=480, variable=self.progress_var, maximum=100)
         self.progress_bar.pack(fill="x", pady=4)
@@ -292,12 +3252,56 @@ class TelegramMusicApp:
 
         # ====== Инициализация ======
         self.chats_all = []
-        self.stats = {"found": 0, "downloaded": 0, "skipped": 0, "duplicates": 0}
+        self.chat_keys = []  # строки поиска в нижнем регистре, параллельно chats_all
+        self.stats = new_stats()
         self.stop_flag = False
+        self.scheduler = None
+        self.jobs_running = False  # идут сканирование/скачивание/наблюдение: дедупликация ждёт их окончания
+        self.authorized = False
+        # Рабочие потоки не трогают Tk напрямую: вызовы идут через очередь ui_call,
+        # прогресс — флагом _jobs_dirty; всё применяется таймером _drain_ui
+        self.ui_queue = queue.Queue()
+        self._jobs_dirty = False
+        self.service = TelegramService(get_transmissions(self.config))
+        self.limiter = make_rate_limiter(self.config)  # общий для всех запусков: помнит FloodWait
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        self.root.after(UI_REFRESH_MS, self._drain_ui)
+        self._first_frame = False
+        self.root.bind("<Map>", self._on_map, add="+")
+        logger.info("UI инициализирован")
+
+    # ====== Отложенная инициализация ======
+    def _on_map(self, event):
+        # Окно показано: работа с диском и импорт pyrogram начинаются после его отрисовки
+        if event.widget is not self.root or self._first_frame:
+            return
+        self._first_frame = True
+        self.root.after_idle(self._after_first_frame)
+
+    def _after_first_frame(self):
+        self.root.update_idletasks()
+        self.startup.mark("first_paint")
+        self.root.after(0, self._deferred_init)
 
+    def _deferred_init(self):
+        os.makedirs(self.download_folder, exist_ok=True)
+        create_auth_template(AUTH_FILE)
+        auth_values = parse_auth_file(AUTH_FILE)
+        for entry, key in ((self.api_id_entry, "api_id"), (self.api_hash_entry, "api_hash"),
+                           (self.phone_entry, "phone_number")):
+            if key in auth_values:
+                entry.delete(0, tk.END)
+                entry.insert(0, auth_values[key])
         self.load_auth_if_no_session()
-        self.update_status()
-        logger.info("UI инициализирован")
+        self.refresh_auth_state()
+        self.load_cached_chats()
+        # pyrogram при импорте берёт event loop текущего потока — импорт в потоке TelegramService
+        self.service.loop.call_soon_threadsafe(load_pyrogram)
+        self.startup.mark("deferred_init")
+        if self.startup.finish():
+            self.root.after(0, self.on_close)
+
     # ====== Методы для кнопки показать/скрыть ======
     def toggle_auth_fields(self):
         self.show_passwords = not self.show_passwords
@@ -343,9 +3347,34 @@ class TelegramMusicApp:
             self.phone_entry.delete(0, tk.END)
             self.phone_entry.insert(0, auth.get("phone_number",""))
 
+    def ui_call(self, fn, *args):
+        # Потокобезопасно: fn выполнится в потоке Tk на ближайшем тике _drain_ui
+        self.ui_queue.put((fn, args))
+
+    def _drain_ui(self):
+        try:
+            while True:
+                try:
+                    fn, args = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("Ошибка обновления интерфейса")
+            if self._jobs_dirty:
+                self._jobs_dirty = False
+                self._render_jobs()
+        finally:
+            self.root.after(UI_REFRESH_MS, self._drain_ui)
+
+    def refresh_auth_state(self):
+        # Проверка файлов сессии — только при входе/выходе/смене данных, не на каждое обновление
+        self.authorized = session_exists(self.session_name_entry.get().strip())
+        self.update_status()
+
     def update_status(self):
-        session_name = self.session_name_entry.get().strip()
-        if session_exists(session_name):
+        if self.authorized:
             self.status_label.config(text="✅ Авторизован", fg="green")
         else:
             self.status_label.config(text="⛔ Не авторизован", fg="red")
@@ -353,6 +3382,8 @@ class TelegramMusicApp:
                       f"Скачано: {self.stats['downloaded']} | "
                       f"Пропущено: {self.stats['skipped']} | "
                       f"Повторов: {self.stats['duplicates']}")
+        if self.stats.get("filtered"):
+            stats_text += f" | Отфильтровано: {self.stats['filtered']}"
         self.stats_label.config(text=stats_text)
 
     # ====== Авторизация ======
@@ -368,27 +3399,45 @@ class TelegramMusicApp:
         except:
             messagebox.showerror("Ошибка", "API ID должно быть числом")
             return
-        try:
-            with Client(session_name, api_id=api_id_int, api_hash=api_hash) as app:
-                me = app.get_me()
-                messagebox.showinfo("Успех", f"Авторизация успешна: {getattr(me, 'first_name', 'user')}")
-            self.save_settings()
+
+        async def get_me(app):
+            return await app.get_me()
+
+        def on_done(fut):
+            try:
+                me = fut.result()
+            except Exception as e:
+                logger.exception("Ошибка авторизации")
+                self.ui_call(lambda err=str(e): (messagebox.showerror("Ошибка авторизации", err), self.refresh_auth_state()))
+                return
             logger.info("Авторизация успешна")
-            self.update_status()
-        except Exception as e:
-            logger.exception("Ошибка авторизации")
-            messagebox.showerror("Ошибка авторизации", str(e))
-            self.update_status()
+            def show():
+                messagebox.showinfo("Успех", f"Авторизация успешна: {getattr(me, 'first_name', 'user')}")
+                self.save_settings()
+                self.refresh_auth_state()
+            self.ui_call(show)
+
+        self.service.submit(self.service.run, session_name, api_id_int, api_hash, get_me).add_done_callback(on_done)
 
     def logout(self):
         session_name = self.session_name_entry.get().strip()
+        # Файлы сессии открыты клиентом — сначала отключаемся
+        try:
+            self.service.call(self.service.stop_client, timeout=10)
+        except Exception:
+            logger.exception("Ошибка остановки клиента при выходе из сессии")
         removed = remove_session_files(session_name)
         if removed:
             messagebox.showinfo("Разлогин", f"Удалено: {', '.join(removed)}")
             logger.info(f"Удалены файлы сессии: {removed}")
         else:
             messagebox.showwarning("Разлогин", "Файлы сессии не найдены")
-        self.update_status()
+        self.refresh_auth_state()
+
+    def on_close(self):
+        self.stop_flag = True
+        self.service.shutdown()
+        self.root.destroy()
 
     def reload_auth_data(self):
         auth = parse_auth_file(AUTH_FILE)
@@ -400,324 +3449,341 @@ class TelegramMusicApp:
         self.phone_entry.insert(0, auth.get("phone_number", ""))
         messagebox.showinfo("Готово", "Данные из auth.txt подгружены (если были).")
         logger.info("Данные auth.txt подгружены")
-        self.update_status()
+        self.refresh_auth_state()
 
     def clear_auth_data(self):
         if os.path.exists(CONFIG_FILE): os.remove(CONFIG_FILE)
+        self.config = {}
         if os.path.exists(AUTH_FILE): os.remove(AUTH_FILE)
         create_auth_template(AUTH_FILE)
         for e in [self.api_id_entry, self.api_hash_entry, self.phone_entry, self.session_name_entry, self.chat_id_entry]:
             e.delete(0, tk.END)
         self.session_name_entry.insert(0, "telegram_music")
-        self.chat_listbox.delete(0, tk.END)
-        self.chats_all = []
-        self.update_status()
+        remove_dialog_cache()
+        self.set_chats([])
+        self.refresh_auth_state()
         messagebox.showinfo("Готово", "Данные авторизации удалены, auth.txt пересоздан.")
         logger.info("Данные авторизации очищены и auth.txt пересоздан")
 
     def save_settings(self):
-        cfg = {
+        cfg = dict(self.config)
+        cfg.update({
             "api_id": self.api_id_entry.get().strip(),
             "api_hash": self.api_hash_entry.get().strip(),
             "session_name": self.session_name_entry.get().strip(),
             "phone_number": self.phone_entry.get().strip(),
             "download_folder": self.download_folder,
-            "chat_id": self.chat_id_entry.get().strip()
-        }
+            "chat_id": self.chat_id_entry.get().strip(),
+            "filters": self.read_filter_fields(),
+            "download_order": self.order_labels.get(self.order_var.get(), "newest"),
+            "max_bandwidth": self.bandwidth_entry.get().strip() or 0
+        })
+        cfg.setdefault("download_workers", get_download_workers(cfg))
+        self.config = cfg
         save_config(cfg)
         messagebox.showinfo("Сохранено", "Настройки сохранены в config.json")
         logger.info("Сохранены настройки пользователя")
 
+    def read_filter_fields(self) -> dict:
+        spec = {key: entry.get().strip() for key, entry in self.filter_entries.items() if entry.get().strip()}
+        kind = self.filter_kind_labels.get(self.filter_kind_var.get(), "all")
+        if kind != "all":
+            spec["kind"] = kind
+        return spec
+
     def cancel_process(self):
         if messagebox.askyesno("Подтверждение", "Действительно остановить процесс?"):
             self.stop_flag = True
             logger.info("Процесс отменен пользователем")
     # ====== Работа со списком чатов ======
-    def fetch_chats(self):
+    def set_chats(self, dialogs: list):
+        self.chats_all = [(dialog_label(d), d["id"], d.get("username") or "") for d in dialogs]
+        self.chat_keys = [label.lower() for label, _, _ in self.chats_all]
+        self.apply_chat_filter()
+
+    def apply_chat_filter(self):
+        # Все слова запроса должны встречаться в названии, id или @username
+        words = self.chat_filter_var.get().lower().split()
+        items = [(str(cid), label) for (label, cid, _), key in zip(self.chats_all, self.chat_keys)
+                 if all(w in key for w in words)]
+        self.chat_listbox.set_items(items)
+        self.chat_count_label.config(text=f"{len(items)} из {len(self.chats_all)}")
+
+    def load_cached_chats(self):
+        # Кэш показывается сразу, затем (если есть сессия) список обновляется в фоне
+        dialogs, updated = load_dialog_cache(self.session_name_entry.get().strip())
+        if dialogs:
+            self.set_chats(dialogs)
+            logger.info(f"Чаты из кэша: {len(dialogs)}")
+        if self.authorized and self.api_id_entry.get().strip() and self.api_hash_entry.get().strip():
+            self.fetch_chats(quiet=True)
+
+    def fetch_chats(self, quiet=False):
         try:
             api_id = int(self.api_id_entry.get().strip())
             api_hash = self.api_hash_entry.get().strip()
             session_name = self.session_name_entry.get().strip()
         except Exception as e:
-            messagebox.showerror("Ошибка", "Неверные данные авторизации")
+            if not quiet:
+                messagebox.showerror("Ошибка", "Неверные данные авторизации")
             logger.error(f"Ошибка при получении данных авторизации: {e}")
             return
-        try:
-            with Client(session_name, api_id=api_id, api_hash=api_hash) as app:
-                self.chat_listbox.delete(0, tk.END)
-                self.chats_all = []
-                for dlg in app.get_dialogs():
-                    title = getattr(dlg.chat, "title", None) or getattr(dlg.chat, "first_name", None) or "Чат"
-                    cid = dlg.chat.id
-                    uname = getattr(dlg.chat, "username", "") or ""
-                    label = f"{title} ({cid})" + (f" [@{uname}]" if uname else "")
-                    self.chats_all.append((label, cid, uname))
-                    self.chat_listbox.insert(tk.END, label)
-                if not self.chats_all:
-                    messagebox.showinfo("Результат", "Чаты не найдены")
-                logger.info(f"Подгружено чатов: {len(self.chats_all)}")
-        except Exception as e:
-            logger.exception("Ошибка при получении списка чатов")
-            messagebox.showerror("Ошибка", str(e))
-
-    def on_chat_select(self, event):
-        sel = event.widget.curselection()
-        if not sel: return
-        idx = sel[0]
-        _, cid, _ = self.chats_all[idx]
-        self.chat_id_entry.delete(0, tk.END)
-        self.chat_id_entry.insert(0, str(cid))
+        cached, updated = load_dialog_cache(session_name)
+        full = self.full_rescan_var.get() or time.time() - updated > DIALOGS_FULL_REFRESH
 
-    async def get_chat_label(self, app, chat_id):
-        try:
-            chat = await app.get_chat(chat_id)
-            title = getattr(chat, "title", None) or getattr(chat, "first_name", None) or f"chat_{chat_id}"
-            uname = getattr(chat, "username", "") or ""
-            return f"{title} ({chat_id})" + (f" [@{uname}]" if uname else "")
-        except Exception:
-            return f"chat_{chat_id}"
+        async def get_dialogs(app):
+            dialogs = await self.limiter.call(fetch_dialogs, app, cached, full)
+            save_dialog_cache(session_name, dialogs)
+            return dialogs
+
+        def show(dialogs):
+            self.set_chats(dialogs)
+            if not self.chats_all and not quiet:
+                messagebox.showinfo("Результат", "Чаты не найдены")
+            logger.info(f"Подгружено чатов: {len(self.chats_all)} ({'полностью' if full else 'изменённые'})")
+
+        def on_done(fut):
+            try:
+                dialogs = fut.result()
+            except Exception as e:
+                logger.exception("Ошибка при получении списка чатов")
+                if not quiet:
+                    self.ui_call(lambda err=str(e): messagebox.showerror("Ошибка", err))
+                return
+            self.ui_call(show, dialogs)
+
+        self.service.submit(self.service.run, session_name, api_id, api_hash, get_dialogs).add_done_callback(on_done)
+
+    def on_chat_select(self, ids):
+        if not ids: return
+        self.chat_id_entry.delete(0, tk.END)
+        self.chat_id_entry.insert(0, ", ".join(ids))
 
     # ====== Потоковое сканирование аудио ======
     def scan_audio_threaded(self):
-        self.stop_flag = False
-        threading.Thread(target=self._scan_worker_thread, daemon=True).start()
+        self._start_jobs("scan", self._scan_worker_thread)
 
-    def _scan_worker_thread(self):
-        self.stats.update({"found":0,"downloaded":0,"skipped":0,"duplicates":0})
-        self.progress_var.set(0)
-        self.update_status()
-
-        chat_id = self.chat_id_entry.get().strip()
-        if not chat_id:
+    def _start_jobs(self, command: str, target, selection: dict = None):
+        # Поля читаются в потоке Tk; рабочий поток получает готовый планировщик
+        chat_ids = list(selection) if selection else parse_chat_ids(self.chat_id_entry.get())
+        if not chat_ids:
             messagebox.showerror("Ошибка", "Выберите чат")
             return
         try:
-            api_id = int(self.api_id_entry.get().strip())
-            api_hash = self.api_hash_entry.get().strip()
-            session_name = self.session_name_entry.get().strip()
+            credentials = (self.session_name_entry.get().strip(), int(self.api_id_entry.get().strip()),
+                           self.api_hash_entry.get().strip())
         except Exception:
             messagebox.showerror("Ошибка", "Неверные данные авторизации")
             return
+        config = dict(self.config, filters=self.read_filter_fields(),
+                      download_order=self.order_labels.get(self.order_var.get(), "newest"))
+        try:
+            ScanFilter(config["filters"])
+        except ValueError as e:
+            messagebox.showerror("Ошибка в фильтрах", str(e))
+            return
+        try:
+            config["max_bandwidth"] = max(0.0, float(self.bandwidth_entry.get().strip() or 0))
+        except ValueError:
+            messagebox.showerror("Ошибка", "Лимит скорости должен быть числом")
+            return
+        self.stop_flag = False
+        self.jobs_running = True
+        self.stats = new_stats()
+        self.progress_var.set(0)
+        self.jobs_label.config(text="")
+        self.metrics_label.config(text="")
+        self.update_status()
+        scheduler = self._make_jobs(chat_ids, config, selection)
+        threading.Thread(target=target, args=(scheduler, credentials), daemon=True).start()
+
+    def _make_jobs(self, chat_ids, config: dict = None, selection: dict = None) -> JobScheduler:
+        labels = {str(cid): label for label, cid, _ in getattr(self, "chats_all", [])}
+        full_rescan = self.full_rescan_var.get()
+        config = self.config if config is None else config
+        selection = selection or {}
+        jobs = [ChatJob(cid, self.download_folder, config, full_rescan=full_rescan,
+                        chat_label=labels.get(cid), on_progress=self._on_job_progress,
+                        should_stop=lambda: self.stop_flag, message_ids=selection.get(cid))
+                for cid in chat_ids]
+        self.scheduler = JobScheduler(jobs, config, self.limiter)
+        return self.scheduler
+
+    def _on_job_progress(self, job, percent):
+        # Вызывается из event loop на каждое сообщение: только отметка, отрисовка — в _drain_ui
+        self._jobs_dirty = True
+
+    def _render_jobs(self):
+        scheduler = self.scheduler
+        if scheduler is None:
+            return
+        self.stats = scheduler.totals()
+        self.progress_var.set(scheduler.percent())
+        snap = scheduler.metrics_snapshot()
+        if snap["bytes_expected"]:
+            self.metrics_label.config(text=format_metrics(snap))
+        if len(scheduler.jobs) > 1:
+            lines = [f"{j.chat_label or j.chat_id}: {j.percent:.0f}% | Найдено: {j.stats['found']} | "
+                     f"Скачано: {j.stats['downloaded']} | Пропущено: {j.stats['skipped']} | Повторов: {j.stats['duplicates']}"
+                     for j in scheduler.jobs[:JOBS_SHOWN]]
+            if len(scheduler.jobs) > JOBS_SHOWN:
+                lines.append(f"… и ещё чатов: {len(scheduler.jobs) - JOBS_SHOWN}")
+            self.jobs_label.config(text="\n".join(lines + self._account_lines(scheduler)))
+        elif scheduler.pool is not None and len(scheduler.pool) > 1:
+            self.jobs_label.config(text="\n".join(self._account_lines(scheduler)))
+        self.update_status()
 
-        timestamp = datetime.now().strftime("%Y.%m.%d - %H_%M")
-        report_file = None
-        error_file = None
-        chat_label = f"chat_{chat_id}"
+    def _account_lines(self, scheduler: JobScheduler) -> list:
+        if scheduler.pool is None or len(scheduler.pool) < 2:
+            return []
+        return ["Аккаунты: " + " | ".join(
+            f"{a['account']}: {a['downloaded']}" + (f" (нет доступа к {a['blocked_chats']})" if a["blocked_chats"] else "")
+            for a in scheduler.pool.snapshot())]
 
-        async def scan_async():
-            nonlocal report_file, error_file, chat_label
-            audio_list = []
-            errors = []
-            try:
-                async with Client(session_name, api_id=api_id, api_hash=api_hash) as app:
-                    chat_label = next(
-                        ((label) for label, cid, _ in getattr(self,"chats_all",[]) if str(cid)==chat_id),
-                        None
-                    )
-                    if not chat_label:
-                        chat_label = await self.get_chat_label(app, chat_id)
-                    safe_label = sanitize_filename(chat_label)
-                    report_file = os.path.join(self.download_folder, f"{timestamp}_scan_report_{safe_label}.txt")
-                    error_file = os.path.join(self.download_folder, f"{timestamp}_scan_errors_{safe_label}.txt")
-
-                    total = 0
-                    async for _ in app.get_chat_history(chat_id):
-                        total +=1
-
-                    processed = 0
-                    async for msg in app.get_chat_history(chat_id):
-                        if self.stop_flag:
-                            errors.append("Сканирование остановлено пользователем")
-                            break
-                        try:
-                            if getattr(msg, "audio", None) or getattr(msg, "voice", None):
-                                audio_list.append(msg)
-                                self.stats["found"] +=1
-                                self.update_status()
-                        except Exception as e:
-                            errors.append(f"Ошибка msg_id {getattr(msg,'id','N/A')}: {e}")
-                        processed += 1
-                        self.root.after(0, lambda v=processed/total*100: self.progress_var.set(v))
-            except Exception as e:
-                logger.exception("Критическая ошибка во время сканирования")
-                errors.append(f"Critical: {e}")
-            return audio_list, errors
+    def _finish_jobs(self, command: str, error: Exception = None):
+        self.jobs_running = False
+        self._render_jobs()
+        self.progress_var.set(0)
+        if error is not None:
+            messagebox.showerror("Ошибка", str(error))
+        elif command == "scan":
+            messagebox.showinfo("Готово", f"Сканирование завершено. Найдено: {self.stats['found']}")
+        elif command == "watch":
+            messagebox.showinfo("Готово", f"Наблюдение остановлено. Найдено: {self.stats['found']} Скачано: {self.stats['downloaded']}")
+        else:
+            messagebox.showinfo("Готово", f"Скачивание завершено. Найдено: {self.stats['found']} Скачано: {self.stats['downloaded']}")
 
-        try:
-            audio_list, errors = asyncio.run(scan_async())
-            # Запись отчета
+    def _run_jobs_thread(self, command: str, scheduler: JobScheduler, credentials):
+        async def run_async():
             try:
-                with open(report_file,"w",encoding="utf-8") as rf:
-                    header = [
-                        "=== Отчёт о сканировании ===",
-                        f"Чат: {chat_label}",
-                        f"Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                        f"Всего найдено: {len(audio_list)}",
-                        f"Скачано: {self.stats['downloaded']}",
-                        f"Пропущено: {self.stats['skipped']}",
-                        f"Повторов: {self.stats['duplicates']}",
-                        "="*30
-                    ]
-                    rf.write("\n".join(header)+"\n")
-                    for msg in audio_list:
-                        try:
-                            if getattr(msg,"audio",None):
-                                ext = mimetypes.guess_extension(msg.audio.mime_type) or ".mp3"
-                                fname = msg.audio.file_name or f"audio_{msg.id}{ext}"
-                                dur = getattr(msg.audio,"duration",None)
-                            elif getattr(msg,"voice",None):
-                                fname = f"voice_{msg.id}.ogg"
-                                dur = getattr(msg.voice,"duration",None)
-                            else:
-                                continue
-                            date_str = getattr(msg,"date",None)
-                            date_formatted = date_str.strftime('%Y-%m-%d %H:%M:%S') if date_str else "N/A"
-                            rf.write(f"{fname} | message_id: {msg.id} | duration: {dur}s | date: {date_formatted}\n")
-                        except Exception as e:
-                            logger.exception(f"Ошибка записи строки отчёта msg {getattr(msg,'id','N/A')}: {e}")
+                async with self.service.session(*credentials) as app:
+                    session_name, api_id, api_hash = credentials
+                    extra = (open_accounts(scheduler.config, api_id, api_hash, session_name)
+                             if command in ("download", "watch") else contextlib.nullcontext([]))
+                    async with extra as accounts:
+                        await scheduler.run(app, command, accounts)
             except Exception as e:
-                logger.exception(f"Не удалось записать файл отчёта: {e}")
+                logger.exception(f"Критическая ошибка: {command}")
+                for job in scheduler.jobs:
+                    job.fail(e)
 
-            if errors:
-                try:
-                    with open(error_file,"w",encoding="utf-8") as ef:
-                        for err in errors:
-                            ef.write(err+"\n")
-                except Exception:
-                    logger.exception("Не удалось записать файл ошибок")
-            messagebox.showinfo("Готово", f"Сканирование завершено. Найдено: {len(audio_list)}")
-            self.progress_var.set(0)
-            self.update_status()
+        try:
+            self.service.call(run_async)
+            scheduler.write_reports(command)
+            if command == "download" and self.config.get("dedup_after_download") and not self.stop_flag:
+                self._run_dedup(show_result=False)
+            self.ui_call(self._finish_jobs, command)
         except Exception as e:
-            logger.exception("Неожиданная ошибка в сканере")
-            messagebox.showerror("Ошибка", str(e))
-            self.progress_var.set(0)
-            self.update_status()
+            logger.exception("Неожиданная ошибка в сканере" if command == "scan" else "Неожиданная ошибка в загрузчике")
+            for job in scheduler.jobs:
+                if job.error_file:
+                    with open(job.error_file,"a",encoding="utf-8") as ef:
+                        ef.write(f"Critical error: {e}\n")
+            self.ui_call(self._finish_jobs, command, e)
+
+    def _scan_worker_thread(self, scheduler, credentials):
+        self._run_jobs_thread("scan", scheduler, credentials)
     # ====== Потоковое скачивание аудио ======
     def download_audio_threaded(self):
-        self.stop_flag = False
-        threading.Thread(target=self._download_worker_thread, daemon=True).start()
+        self._start_jobs("download", self._download_worker_thread)
 
-    def _download_worker_thread(self):
-        self.stats.update({"found":0,"downloaded":0,"skipped":0,"duplicates":0})
-        self.progress_var.set(0)
-        self.update_status()
+    def _download_worker_thread(self, scheduler, credentials):
+        self._run_jobs_thread("download", scheduler, credentials)
 
-        chat_id = self.chat_id_entry.get().strip()
-        if not chat_id:
-            messagebox.showerror("Ошибка","Выберите чат")
-            return
-        try:
-            api_id = int(self.api_id_entry.get().strip())
-            api_hash = self.api_hash_entry.get().strip()
-            session_name = self.session_name_entry.get().strip()
-        except Exception:
-            messagebox.showerror("Ошибка","Неверные данные авторизации")
-            return
+    # ====== Наблюдение за новыми аудио ======
+    def watch_audio_threaded(self):
+        self._start_jobs("watch", self._watch_worker_thread)
 
-        timestamp = datetime.now().strftime("%Y.%m.%d - %H_%M")
-        report_file = None
-        error_file = None
-        chat_label = f"chat_{chat_id}"
+    def _watch_worker_thread(self, scheduler, credentials):
+        self._run_jobs_thread("watch", scheduler, credentials)
 
-        async def download_async():
-            nonlocal report_file, error_file, chat_label
-            errors = []
-            to_download=[]
-            try:
-                async with Client(session_name, api_id=api_id, api_hash=api_hash) as app:
-                    chat_label = next(
-                        ((label) for label, cid, _ in getattr(self,"chats_all",[]) if str(cid)==chat_id),
-                        None
-                    )
-                    if not chat_label:
-                        chat_label = await self.get_chat_label(app, chat_id)
-                    safe_label = sanitize_filename(chat_label)
-                    chat_folder = os.path.join(self.download_folder, safe_label)
-                    os.makedirs(chat_folder, exist_ok=True)
-                    report_file = os.path.join(chat_folder, f"{timestamp}_downloaded_{safe_label}.txt")
-                    error_file = os.path.join(chat_folder, f"{timestamp}_download_errors_{safe_label}.txt")
-
-                    async for msg in app.get_chat_history(chat_id):
-                        if self.stop_flag:
-                            errors.append("Скачивание остановлено пользователем")
-                            break
-                        if getattr(msg,"audio",None) or getattr(msg,"voice",None):
-                            to_download.append(msg)
+    # ====== Каталог ======
+    def open_catalog(self):
+        if not os.path.exists(os.path.join(self.download_folder, INDEX_FILE)):
+            messagebox.showerror("Ошибка", "Каталог пуст: сначала просканируйте чаты")
+            return
+        CatalogWindow(self.root, self.download_folder, on_download=self.download_messages)
 
-                    total = len(to_download)
-                    self.stats["found"]=total
+    def download_messages(self, selection: dict):
+        self._start_jobs("download", self._download_worker_thread, selection)
 
-                    for idx,msg in enumerate(to_download):
-                        if self.stop_flag: break
-                        try:
-                            if getattr(msg,"audio",None):
-                                ext = mimetypes.guess_extension(msg.audio.mime_type) or ".mp3"
-                                fname = msg.audio.file_name or f"audio_{msg.id}{ext}"
-                            else:
-                                fname = f"voice_{msg.id}.ogg"
-                            safe_name = sanitize_filename(fname)
-                            out_path = os.path.join(chat_folder,safe_name)
-                            if os.path.exists(out_path) and os.path.getsize(out_path)>0:
-                                self.stats["duplicates"] += 1
-                                logger.info(f"Пропущен (duplicate): {out_path}")
-                            else:
-                                await msg.download(file_name=out_path)
-                                self.stats["downloaded"] += 1
-                                logger.info(f"Скачано: {out_path}")
-                        except Exception as e:
-                            self.stats["skipped"] +=1
-                            errtxt = f"Ошибка msg_id {getattr(msg,'id','N/A')}: {e}"
-                            errors.append(errtxt)
-                            logger.exception(errtxt)
-                        self.root.after(0, lambda v=(idx+1)/total*100: self.progress_var.set(v))
-                        self.update_status()
-            except Exception as e:
-                logger.exception("Критическая ошибка во время скачивания")
-                errors.append(f"Critical: {e}")
-            return len(to_download), errors
-
-        try:
-            count, errors = asyncio.run(download_async())
-            try:
-                with open(report_file,"w",encoding="utf-8") as rf:
-                    header = [
-                        "=== Отчёт о скачивании ===",
-                        f"Чат: {chat_label} ({chat_id})",
-                        f"Дата генерации: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                        f"Всего найдено: {self.stats['found']}",
-                        f"Скачано: {self.stats['downloaded']}",
-                        f"Пропущено: {self.stats['skipped']}",
-                        f"Повторов: {self.stats['duplicates']}",
-                        "="*30
-                    ]
-                    rf.write("\n".join(header))
-            except Exception:
-                logger.exception("Не удалось записать файл отчёта скачивания")
+    # ====== Дедупликация библиотеки ======
+    def dedup_threaded(self):
+        if not os.path.isdir(self.download_folder):
+            messagebox.showerror("Ошибка", "Папка загрузки не найдена")
+            return
+        if self.jobs_running:
+            # Хэширование и замена файлов ссылками не должны идти параллельно с записью в библиотеку и индекс
+            messagebox.showwarning("Дедупликация", "Дождитесь окончания сканирования или скачивания")
+            return
+        if not messagebox.askyesno("Дедупликация", "Одинаковые файлы в папке загрузки будут заменены "
+                                                   "жёсткими ссылками на один экземпляр. Продолжить?"):
+            return
+        self.progress_var.set(0)
+        threading.Thread(target=self._run_dedup, daemon=True).start()
 
-            if errors:
-                try:
-                    with open(error_file,"w",encoding="utf-8") as ef:
-                        for err in errors:
-                            ef.write(err+"\n")
-                except Exception:
-                    logger.exception("Не удалось записать файл ошибок скачивания")
+    def _run_dedup(self, show_result: bool = True):
+        def on_progress(done, total):
+            self.ui_call(self.progress_var.set, done / total * 100)
 
-            messagebox.showinfo("Готово", f"Скачивание завершено. Найдено: {self.stats['found']} Скачано: {self.stats['downloaded']}")
-            self.progress_var.set(0)
-            self.update_status()
+        try:
+            summary = dedup_library(self.download_folder, get_hash_workers(self.config), on_progress=on_progress)
         except Exception as e:
-            logger.exception("Неожиданная ошибка в загрузчике")
-            if error_file:
-                with open(error_file,"a",encoding="utf-8") as ef:
-                    ef.write(f"Critical error: {e}\n")
-            messagebox.showerror("Ошибка", str(e))
-            self.progress_var.set(0)
-            self.update_status()
+            logger.exception("Ошибка дедупликации")
+            self.ui_call(lambda err=str(e): messagebox.showerror("Ошибка дедупликации", err))
+            return
+        if show_result:
+            self.ui_call(lambda: (self.progress_var.set(0),
+                                  messagebox.showinfo("Дедупликация", format_dedup_summary(summary))))
 
 
 # ====== Запуск приложения ======
-if __name__ == "__main__":
+class StartupTimer:
+    # Отметки от начала импорта модуля: import, logging, tk, init (окно построено), first_paint,
+    # deferred_init. Разбивка по этапам пишется в лог; с --startup-timing — ещё и JSON в stdout,
+    # после чего окно закрывается
+    def __init__(self, exit_after: bool = False):
+        self.exit_after = exit_after
+        self.marks = {}
+
+    def mark(self, name: str):
+        self.marks[name] = time.perf_counter() - _IMPORT_STARTED
+
+    def report(self) -> dict:
+        phases, last = {}, 0.0
+        for name, at in self.marks.items():
+            phases[name] = round(at - last, 4)
+            last = at
+        phases["total"] = round(last, 4)
+        return phases
+
+    def finish(self) -> bool:
+        phases = self.report()
+        logger.info("Запуск: " + ", ".join(f"{name} {sec:.3f} с" for name, sec in phases.items()))
+        if self.exit_after:
+            print(json.dumps(phases, ensure_ascii=False), flush=True)
+        return self.exit_after
+
+def run_gui(startup: StartupTimer = None):
+    startup = startup or StartupTimer()
+    load_tkinter()
     root = tk.Tk()
-    app = TelegramMusicApp(root)
+    startup.mark("tk")
+    TelegramMusicApp(root, startup)  # живёт в обработчиках Tk (after, protocol, bind)
+    startup.mark("init")
     root.mainloop()
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and (argv[0] in CLI_COMMANDS or argv[0] in ("-h", "--help")):
+        return cli_main(argv)
+    startup = StartupTimer(exit_after="--startup-timing" in argv)
+    startup.mark("import")
+    setup_logging(load_config())
+    logger.info("Запуск приложения")
+    startup.mark("logging")
+    run_gui(startup)
+    return EXIT_OK
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Офлайн-бенчмарк сканирования и скачивания без аккаунта Telegram.
+# pyrogram.Client подменяется локальной заглушкой с синтетической (или записанной)
+# историей чата; дальше работает настоящий код TGmdown: TelegramService, JobScheduler,
+# AudioScanner, конвейер загрузки, индекс и RateLimiter — то же, что запускают
+# _scan_worker_thread/_download_worker_thread в GUI, но без Tk.
+#
+#   python tgmdown_bench.py --messages 5000 --density 0.3 --latency 50 --bandwidth 4 --flood-every 200
+#   python tgmdown_bench.py --compare
+#
+# Каждый прогон дописывается строкой JSON в bench_results.jsonl (версия, параметры, результаты)
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import shutil
+import subprocess
+import types
+from datetime import datetime, timezone
+
+from pyrogram import enums
+from pyrogram.errors import FloodWait
+
+import TGmdown
+
+RESULTS_FILE = "bench_results.jsonl"
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ====== Синтетическая история ======
+# Сообщение истории — словарь {"id", "kind": audio|voice|None, "size", "duration",
+# "file_name", "performer", "title", "uid"}; новые сообщения первыми, как в get_chat_history
+def make_history(messages: int, density: float, voice_share: float, file_size: int, dup_share: float,
+                 rng: random.Random, shared_uids: list) -> list:
+    history = []
+    for msg_id in range(messages, 0, -1):
+        if rng.random() >= density:
+            history.append({"id": msg_id, "kind": None})
+            continue
+        kind = "voice" if rng.random() < voice_share else "audio"
+        size = rng.randint(file_size // 2, file_size * 3 // 2) if kind == "audio" else max(1, file_size // 8)
+        if shared_uids and rng.random() < dup_share:
+            # Репост уже существующего файла (в этом или другом чате)
+            uid, size = rng.choice(shared_uids)
+        else:
+            uid = f"u{rng.getrandbits(48):012x}"
+            shared_uids.append((uid, size))
+        history.append({
+            "id": msg_id, "kind": kind, "size": size, "duration": rng.randint(5, 600),
+            "file_name": f"track_{msg_id}.mp3" if kind == "audio" else None,
+            "performer": f"Artist {rng.randint(1, 200)}", "title": f"Song {msg_id}", "uid": uid,
+        })
+    return history
+
+def load_history(path: str) -> dict:
+    # {chat_id: [сообщения]} — например, сохранённое через --save-history
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {str(chat_id): sorted(msgs, key=lambda m: -m["id"]) for chat_id, msgs in data.items()}
+
+# ====== Заглушка Client ======
+class FakeMedia:
+    def __init__(self, entry: dict, chat_id: str):
+        self.file_id = f"{chat_id}:{entry['id']}"
+        self.file_unique_id = entry["uid"]
+        self.file_size = entry["size"]
+        self.duration = entry["duration"]
+        self.mime_type = "audio/mpeg" if entry["kind"] == "audio" else "audio/ogg"
+        self.file_name = entry.get("file_name")
+        self.performer = entry.get("performer")
+        self.title = entry.get("title")
+
+class FakeMessage:
+    def __init__(self, entry: dict, chat_id: str):
+        self.id = entry["id"]
+        self.date = datetime.fromtimestamp(1_600_000_000 + entry["id"] * 60)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        media = FakeMedia(entry, chat_id) if entry["kind"] else None
+        self.audio = media if entry["kind"] == "audio" else None
+        self.voice = media if entry["kind"] == "voice" else None
+
+class BenchWorld:
+    # Общие для всех экземпляров FakeClient параметры и счётчики прогона
+    def __init__(self, chats: dict, latency: float, bandwidth: float, flood_every: int, flood_seconds: int,
+                 media_setup: float = 0.0, history_walk: bool = False):
+        self.chats = {chat_id: [FakeMessage(e, chat_id) for e in msgs] for chat_id, msgs in chats.items()}
+        self.media = {m.audio.file_id if m.audio else m.voice.file_id: (m.audio or m.voice).file_size
+                      for msgs in self.chats.values() for m in msgs if m.audio or m.voice}
+        self.latency = latency
+        self.bandwidth = bandwidth  # байт/с на один поток stream_media, 0 — без ограничения
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.media_setup = media_setup  # сек. на открытие media-сессии в каждом stream_media
+        self.history_walk = history_walk  # поиск по фильтрам недоступен: сканер идёт по истории
+        self.api_calls = 0
+        self.floods = 0
+
+    async def api_call(self):
+        # Номер вызова берётся до паузы: за время latency счётчик успевают сдвинуть другие задачи
+        self.api_calls += 1
+        n = self.api_calls
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_every and n % self.flood_every == 0:
+            self.floods += 1
+            raise FloodWait(value=self.flood_seconds)
+
+WORLD = None
+FILTER_KINDS = {enums.MessagesFilter.AUDIO: "audio", enums.MessagesFilter.VOICE_NOTE: "voice"}
+ZERO_CHUNK = bytes(TGmdown.CHUNK_SIZE)
+
+class FakeClient:
+    def __init__(self, name, api_id=None, api_hash=None, max_concurrent_transmissions=1, **kwargs):
+        self.name = name
+        self.is_connected = False
+        # Как get_file_semaphore в Pyrogram: передача занимает место на весь stream_media
+        self.transmissions = asyncio.Semaphore(max_concurrent_transmissions)
+
+    async def start(self):
+        self.is_connected = True
+        return self
+
+    async def stop(self):
+        self.is_connected = False
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def get_me(self):
+        return types.SimpleNamespace(first_name="bench")
+
+    async def get_chat(self, chat_id):
+        await WORLD.api_call()
+        return types.SimpleNamespace(title=f"Bench {chat_id}", username="")
+
+    def _history(self, chat_id):
+        return WORLD.chats[str(chat_id)]
+
+    async def get_chat_history_count(self, chat_id):
+        await WORLD.api_call()
+        return len(self._history(chat_id))
+
+    async def search_messages_count(self, chat_id, filter=None, **kwargs):
+        await WORLD.api_call()
+        if WORLD.history_walk:
+            raise ValueError("поиск по фильтрам отключён (--history-walk)")
+        kind = FILTER_KINDS[filter]
+        return sum(1 for m in self._history(chat_id) if getattr(m, kind))
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0, offset_date=None, **kwargs):
+        await WORLD.api_call()
+        msgs = [m for m in self._history(chat_id) if not offset_id or m.id < offset_id]
+        if offset_date and offset_date.timestamp() > 0:
+            # Как в API: только сообщения строго старше offset_date
+            msgs = [m for m in msgs if m.date < offset_date]
+        for m in msgs[:limit or None]:
+            yield m
+
+    async def search_messages(self, chat_id, filter=None, offset=0, limit=0, **kwargs):
+        await WORLD.api_call()
+        kind = FILTER_KINDS[filter]
+        msgs = [m for m in self._history(chat_id) if getattr(m, kind)][offset:]
+        for m in msgs[:limit or None]:
+            yield m
+
+    async def get_messages(self, chat_id, message_ids):
+        await WORLD.api_call()
+        by_id = {m.id: m for m in self._history(chat_id)}
+        if isinstance(message_ids, (list, tuple)):
+            return [by_id.get(i) for i in message_ids]
+        return by_id.get(message_ids)
+
+    async def stream_media(self, media, limit=0, offset=0):
+        size = WORLD.media[media if isinstance(media, str) else (media.audio or media.voice).file_id]
+        async with self.transmissions:
+            try:
+                await WORLD.api_call()
+            except FloodWait:
+                # Как get_file в Pyrogram: FloodWait не пробрасывается, поток просто кончается раньше файла
+                return
+            if WORLD.media_setup:
+                await asyncio.sleep(WORLD.media_setup)
+            chunks = 0
+            for start in range(offset * TGmdown.CHUNK_SIZE, size, TGmdown.CHUNK_SIZE):
+                if limit and chunks >= limit:
+                    return
+                chunk = ZERO_CHUNK if start + TGmdown.CHUNK_SIZE <= size else ZERO_CHUNK[:size - start]
+                if WORLD.bandwidth:
+                    await asyncio.sleep(len(chunk) / WORLD.bandwidth)
+                else:
+                    await asyncio.sleep(0)
+                chunks += 1
+                yield chunk
+
+# ====== Прогон ======
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def code_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+def run_phase(service, command: str, chat_ids: list, folder: str, config: dict) -> dict:
+    # Как TelegramMusicApp._run_jobs_thread: планировщик выполняется в потоке TelegramService
+    first_record = None
+    started = time.monotonic()
+
+    def on_progress(job, percent):
+        nonlocal first_record
+        if first_record is None:
+            first_record = time.monotonic() - started
+
+    jobs = [TGmdown.ChatJob(cid, folder, config, full_rescan=True, chat_label=f"bench_{cid}", on_progress=on_progress)
+            for cid in chat_ids]
+    scheduler = TGmdown.JobScheduler(jobs, config)
+
+    async def run_async():
+        async with service.session("bench", 1, "bench") as app:
+            await scheduler.run(app, command)
+
+    calls_before, floods_before = WORLD.api_calls, WORLD.floods
+    service.call(run_async)
+    elapsed = time.monotonic() - started
+    scheduler.write_reports(command)
+
+    totals = scheduler.totals()
+    snap = scheduler.metrics_snapshot()
+    messages = sum(len(WORLD.chats[cid]) for cid in chat_ids)
+    result = {
+        "elapsed_seconds": round(elapsed, 3),
+        "messages": messages,
+        "messages_per_second": round(messages / elapsed, 1) if elapsed else None,
+        "found": totals["found"],
+        "records_per_second": round(totals["found"] / elapsed, 1) if elapsed else None,
+        "api_calls": WORLD.api_calls - calls_before,
+        "flood_waits_injected": WORLD.floods - floods_before,
+        "errors": sum(len(job.errors) for job in jobs),
+        "critical": any(job.critical for job in jobs),
+        "time_to_first_record": None if first_record is None else round(first_record, 3),
+    }
+    if command == "download":
+        result.update({
+            "downloaded": totals["downloaded"],
+            "duplicates": totals["duplicates"],
+            "skipped": totals["skipped"],
+            "bytes": snap["bytes_downloaded"],
+            "mb_per_second": round(snap["bytes_downloaded"] / elapsed / (1024 * 1024), 2) if elapsed else None,
+            "ttfb_seconds": snap["ttfb_seconds"],
+            "file_seconds_p50": snap["file_seconds_p50"],
+            "file_seconds_p90": snap["file_seconds_p90"],
+            "file_seconds_p99": snap["file_seconds_p99"],
+        })
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tgmdown_bench.py", description="Офлайн-бенчмарк TGmdown на заглушке Client")
+    parser.add_argument("--command", choices=("scan", "download", "both"), default="both")
+    parser.add_argument("--chats", type=int, default=1, help="Число чатов (по умолчанию %(default)s)")
+    parser.add_argument("--messages", type=int, default=2000, help="Сообщений в каждом чате")
+    parser.add_argument("--density", type=float, default=0.25, help="Доля сообщений с аудио/голосовыми")
+    parser.add_argument("--voice-share", type=float, default=0.2, help="Доля голосовых среди медиа")
+    parser.add_argument("--dup-share", type=float, default=0.05, help="Доля репостов уже встречавшихся файлов")
+    parser.add_argument("--file-size", type=float, default=1.0, help="Средний размер аудиофайла, МБ")
+    parser.add_argument("--latency", type=float, default=20.0, help="Задержка одного вызова API, мс")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="МБ/с на один поток загрузки (0 — без ограничения)")
+    parser.add_argument("--flood-every", type=int, default=0, help="FloodWait на каждый N-й вызов API (0 — выкл.)")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="Длительность FloodWait, сек.")
+    parser.add_argument("--media-setup", type=float, default=50.0,
+                        help="Открытие media-сессии в начале каждого stream_media, мс")
+    parser.add_argument("--history-walk", action="store_true",
+                        help="Без поиска по фильтрам: сканирование проходом по истории")
+    parser.add_argument("--filters", help='Фильтры сканирования в JSON, как "filters" в config.json')
+    parser.add_argument("--workers", type=int, help="download_workers")
+    parser.add_argument("--api-rate", type=float, help="api_rate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--history", help="JSON с записанной историей {chat_id: [сообщения]} вместо синтетической")
+    parser.add_argument("--save-history", help="Сохранить сгенерированную историю в JSON")
+    parser.add_argument("--folder", help="Папка загрузки (по умолчанию временная, удаляется после прогона)")
+    parser.add_argument("--results", default=RESULTS_FILE, help="Файл результатов (по умолчанию %(default)s)")
+    parser.add_argument("--label", default="", help="Метка прогона для сравнения")
+    parser.add_argument("--compare", action="store_true", help="Показать таблицу сохранённых результатов и выйти")
+    return parser
+
+def print_comparison(path: str):
+    if not os.path.exists(path):
+        print(f"Нет результатов: {path}")
+        return
+    columns = ("version", "label", "command", "messages", "elapsed_seconds", "messages_per_second",
+               "mb_per_second", "ttfb_seconds", "peak_rss_mb")
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            run = json.loads(line)
+            for command, result in run["results"].items():
+                rows.append([run.get("version", ""), run.get("label", ""), command] +
+                            [result.get(c, "") for c in columns[3:]])
+    rows = [[("" if v is None else str(v)) for v in row] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in rows)) if rows else len(c) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+def main(argv=None) -> int:
+    global WORLD
+    args = build_parser().parse_args(argv)
+    if args.compare:
+        print_comparison(args.results)
+        return 0
+
+    rng = random.Random(args.seed)
+    if args.history:
+        chats = load_history(args.history)
+    else:
+        shared = []
+        chats = {str(-1000 - i): make_history(args.messages, args.density, args.voice_share,
+                                              int(args.file_size * 1024 * 1024), args.dup_share, rng, shared)
+                 for i in range(args.chats)}
+    if args.save_history:
+        with open(args.save_history, "w", encoding="utf-8") as f:
+            json.dump(chats, f)
+
+    WORLD = BenchWorld(chats, args.latency / 1000, args.bandwidth * 1024 * 1024, args.flood_every, args.flood_seconds,
+                       args.media_setup / 1000, args.history_walk)
+    work_dir = tempfile.mkdtemp(prefix="tgmdown_bench_")
+    # Лог прогона — во временной папке, а не в logs/ текущего каталога
+    TGmdown.LOG_DIR = os.path.join(work_dir, "logs")
+    TGmdown.setup_logging()
+    TGmdown.load_pyrogram()  # иначе первый get_client вернёт на место настоящий Client
+    TGmdown.Client = FakeClient
+
+    folder = args.folder or os.path.join(work_dir, "download")
+    os.makedirs(folder, exist_ok=True)
+    # Отметки прогонов бенчмарка не должны попасть в state.json пользователя
+    TGmdown.STATE_FILE = os.path.join(work_dir, "state.json")
+    config = {}
+    if args.workers is not None:
+        config["download_workers"] = args.workers
+    if args.api_rate is not None:
+        config["api_rate"] = args.api_rate
+    if args.filters:
+        config["filters"] = json.loads(args.filters)
+
+    commands = ("scan", "download") if args.command == "both" else (args.command,)
+    service = TGmdown.TelegramService(TGmdown.get_transmissions(config))
+    results = {}
+    try:
+        for command in commands:
+            results[command] = run_phase(service, command, list(chats), folder, config)
+            print(json.dumps({command: results[command]}, ensure_ascii=False), flush=True)
+    finally:
+        service.shutdown()
+        TGmdown.stop_logging()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "version": code_version(),
+        "label": args.label,
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ("compare", "results", "label", "folder")},
+        "results": results,
+    }
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run, ensure_ascii=False) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())